@@ -0,0 +1,75 @@
+'''
+Check of the BSP solvers (--bsp_solver of opt.py) against the full SVD.
+The features of successive source and target batches are computed by the feature extractor of the model in
+--load_path (or of a randomly initialized model), and for every step the penalty and its gradients with respect
+to the features are compared with those of the full SVD. The solvers keep their state across the steps, so the
+power iteration is warm-started as in training. The time of a forward and backward pass of each solver is also
+reported.
+
+Example: Check the top-3 penalty on the features of a DANN model trained from CWRU operation condition 0 to condition 1.
+python bsp_check.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --bsp_k 3
+'''
+import sys
+sys.path.extend(['./models', './data_loader'])
+import time
+import torch
+import logging
+import numpy as np
+
+import utils
+import inference_utils
+from opt import get_parser
+from BSP import BatchSpectralPenalizationLoss
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--num_steps', type=int, default=50, help='Number of compared steps')
+    args = parser.parse_args()
+    return args
+
+
+def penalty_and_grads(bsp, f_s, f_t):
+    f_s, f_t = f_s.detach().requires_grad_(True), f_t.detach().requires_grad_(True)
+    loss = bsp(f_s, f_t)
+    g_s, g_t = torch.autograd.grad(loss, [f_s, f_t])
+    return loss.detach(), torch.cat([g_s.flatten(), g_t.flatten()])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    if args.random_state is not None:
+        torch.manual_seed(args.random_state)
+    args = inference_utils.prepare_args(args)
+    trainer = inference_utils.build_trainer(args)
+    G = inference_utils.get_inference_model(trainer).G
+    src = args.source_name[0]
+
+    solvers = {name: BatchSpectralPenalizationLoss(1., k=args.bsp_k, solver=name, power_iters=args.bsp_power_iters)
+               for name in ['svd', 'power', 'lowrank']}
+    errors = {name: {'loss': [], 'grad': []} for name in ['power', 'lowrank']}
+    times = {name: [] for name in solvers}
+    for step in range(args.num_steps):
+        source_data, _ = utils.get_next_batch(trainer.dataloaders, trainer.iters, src, trainer.device)
+        target_data, _ = utils.get_next_batch(trainer.dataloaders, trainer.iters, 'train', trainer.device)
+        with torch.no_grad():
+            f_s, f_t = G(source_data), G(target_data)
+        results = {}
+        for name, bsp in solvers.items():
+            start = time.perf_counter()
+            results[name] = penalty_and_grads(bsp, f_s, f_t)
+            times[name].append((time.perf_counter() - start) * 1000)
+        loss_ref, grad_ref = results['svd']
+        for name in errors:
+            loss, grad = results[name]
+            errors[name]['loss'].append(float((loss - loss_ref).abs() / loss_ref))
+            errors[name]['grad'].append(float((grad - grad_ref).norm() / grad_ref.norm()))
+
+    for name in errors:
+        logging.info('{}: relative error of the penalty {:.2e} (max {:.2e}), of the gradients {:.2e} (max {:.2e})'.format(
+                     name, np.mean(errors[name]['loss']), np.max(errors[name]['loss']),
+                     np.mean(errors[name]['grad']), np.max(errors[name]['grad'])))
+    for name in solvers:
+        logging.info('{}: {:.2f} ms forward and backward'.format(name, np.median(times[name][1:])))
+    logger.handlers.clear()
@@ -0,0 +1,220 @@
+'''
+Early-exit cascaded inference over the branches of the feature extractor.
+A cheap subset of the trained branches (--exit_kernels) is evaluated first with an auxiliary head, which is
+distilled from the full model. Windows whose exit confidence is above a threshold are classified by the
+auxiliary head, and the others escalate to the full model, which reuses the features of the cheap branches.
+The threshold is calibrated on the target validation set so that the accuracy of the cascade stays within
+--max_acc_drop of the full model, while as many windows as possible exit early.
+
+Example: Build a cascade for a DANN model trained from CWRU operation condition 0 to condition 1.
+python cascade.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import json
+import time
+import torch
+import logging
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+
+import model_base
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--exit_kernels', type=str, default='4,8',
+                        help='Kernel sizes of the branches evaluated before the early exit, separated by ","')
+    parser.add_argument('--exit_epochs', type=int, default=5, help='Epochs of distillation of the auxiliary head')
+    parser.add_argument('--exit_lr', type=float, default=1e-2,
+                        help='Learning rate of distillation of the auxiliary head')
+    parser.add_argument('--max_acc_drop', type=float, default=0.01,
+                        help='Maximum drop of validation accuracy of the cascade')
+    parser.add_argument('--latency_windows', type=int, default=200,
+                        help='Number of single windows to measure the mean latency')
+    args = parser.parse_args()
+    return args
+
+
+class ExitBranch(nn.Module):
+    '''
+    Subset of the trained branches of G followed by an auxiliary head. The branches are shared with the
+    full model and stay frozen, so only the head is trained.
+    '''
+    def __init__(self, G, branches, head):
+        super(ExitBranch, self).__init__()
+        self.G = G
+        self.branches = branches
+        self.head = head
+        for p in self.G.parameters():
+            p.requires_grad = False
+
+    def train(self, mode=True):
+        super(ExitBranch, self).train(mode)
+        # Keep the running statistics of the shared BatchNorm layers
+        self.G.eval()
+        return self
+
+    def features(self, inputs):
+        '''
+        Features of the branches from the branch inputs of G.
+        '''
+        return [self.G.convs[b](inputs[b]) for b in self.branches]
+
+    def forward(self, input):
+        return self.head(torch.cat(self.features(self.G.branch_inputs(input)), dim=1))
+
+
+class CascadeModel(nn.Module):
+    '''
+    Early exit at the ExitBranch if its confidence (maximum softmax probability) is above threshold,
+    otherwise the full InferenceModel. The output is always logits.
+    '''
+    def __init__(self, model, exit_branches, exit_head, threshold=1.):
+        super(CascadeModel, self).__init__()
+        self.model = model
+        self.exit_branches = exit_branches
+        self.exit = ExitBranch(model.G, exit_branches, exit_head)
+        self.register_buffer('threshold', torch.tensor(float(threshold)))
+
+    def forward(self, input):
+        G = self.model.G
+        inputs = G.branch_inputs(input)
+        f_exit = self.exit.features(inputs)
+        y = self.exit.head(torch.cat(f_exit, dim=1))
+        escalate = F.softmax(y, dim=1).max(dim=1)[0] <= self.threshold
+        if escalate.any():
+            f = []
+            for b, conv in enumerate(G.convs):
+                if b in self.exit_branches:
+                    f.append(f_exit[self.exit_branches.index(b)][escalate])
+                else:
+                    f.append(conv(inputs[b][escalate]))
+            y = y.clone()
+            y[escalate] = self.model.classify(G.fl(torch.cat(f, dim=1)))
+        return y
+
+
+def load_cascade(model, path):
+    '''
+    CascadeModel of an InferenceModel with the auxiliary head saved by this script.
+    '''
+    ckpt = torch.load(path, map_location=next(model.parameters()).device)
+    window_sizes = model.G.window_sizes
+    exit_head = model_base.ClassifierMLP(ckpt['feature_size'], ckpt['num_classes'], 0., last=None,
+                                         rank=ckpt['rank'])
+    exit_head.load_state_dict(ckpt['exit_head'])
+    cascade = CascadeModel(model, [window_sizes.index(h) for h in ckpt['exit_kernels']],
+                           exit_head.to(next(model.parameters()).device), ckpt['threshold'])
+    return cascade.eval()
+
+
+def predict(model, dataloader, device):
+    '''
+    Logits and labels of every sample of a dataloader.
+    '''
+    model.eval()
+    logits, labels = [], []
+    with torch.no_grad():
+        for data, label, _ in dataloader:
+            logits.append(model(data.to(device)))
+            labels.append(label.to(device))
+    return torch.cat(logits, dim=0), torch.cat(labels, dim=0)
+
+
+def calibrate(exit_logits, full_logits, labels, max_acc_drop):
+    '''
+    Lowest confidence threshold with which the accuracy of the cascade is within max_acc_drop of the
+    full model. The most confident windows exit first, so the accuracy of exiting k windows is evaluated
+    for every k at once.
+    '''
+    confidence = F.softmax(exit_logits, dim=1).max(dim=1)[0]
+    order = confidence.argsort(descending=True)
+    exit_correct = (exit_logits.argmax(dim=1) == labels)[order].float()
+    full_correct = (full_logits.argmax(dim=1) == labels)[order].float()
+    zero = torch.zeros(1, device=labels.device)
+    # acc[k]: Accuracy if the k most confident windows exit early
+    acc = (torch.cat((zero, exit_correct.cumsum(0))) +
+           full_correct.sum() - torch.cat((zero, full_correct.cumsum(0)))) / len(labels)
+    k = int(torch.nonzero(acc >= full_correct.mean() - max_acc_drop).max())
+    # Windows exit if their confidence is strictly above the threshold
+    sorted_conf = confidence[order]
+    return float(sorted_conf[k]) if k < len(labels) else 0.
+
+
+def mean_latency(model, dataloader, num_windows, device):
+    '''
+    Mean and maximum wall-clock time in milliseconds of single windows, as in a stream.
+    '''
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for data, _, _ in dataloader:
+            for x in data.split(1):
+                x = x.to(device)
+                start = time.perf_counter()
+                model(x)
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                times.append((time.perf_counter() - start) * 1000)
+                if len(times) >= num_windows:
+                    return float(np.mean(times)), float(np.max(times))
+    return float(np.mean(times)), float(np.max(times))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    if args.random_state is not None:
+        torch.manual_seed(args.random_state)
+    args = inference_utils.prepare_args(args)
+
+    trainer = inference_utils.build_trainer(args)
+    model = inference_utils.get_inference_model(trainer)
+    for p in model.parameters():
+        p.requires_grad = False
+    device, val_loader = trainer.device, trainer.dataloaders['val']
+
+    window_sizes = model.G.window_sizes
+    exit_kernels = [int(h) for h in args.exit_kernels.split(',')]
+    if not set(exit_kernels) < set(window_sizes):
+        raise Exception("The exit kernels must be a proper subset of the kernel sizes {}.".format(window_sizes))
+    exit_branches = [window_sizes.index(h) for h in exit_kernels]
+    example = next(iter(val_loader))[0].to(device)
+    inputs = model.G.branch_inputs(example)
+    feature_size = sum([model.G.convs[b](inputs[b]).shape[1] for b in exit_branches])
+    exit_head = model_base.ClassifierMLP(feature_size, args.num_classes, args.dropout, last=None,
+                                         rank=args.head_rank).to(device)
+
+    cascade = CascadeModel(model, exit_branches, exit_head)
+    inference_utils.finetune(cascade.exit, model, trainer, args.exit_epochs, args.exit_lr)
+
+    exit_logits, labels = predict(cascade.exit, val_loader, device)
+    full_logits, _ = predict(model, val_loader, device)
+    cascade.threshold.fill_(calibrate(exit_logits, full_logits, labels, args.max_acc_drop))
+
+    exit_rate = float((F.softmax(exit_logits, dim=1).max(dim=1)[0] > cascade.threshold).float().mean())
+    report = {'exit_kernels': exit_kernels, 'threshold': float(cascade.threshold), 'exit_rate': exit_rate}
+    for name, m in [('full', model), ('exit', cascade.exit), ('cascade', cascade)]:
+        logits, _ = predict(m, val_loader, device)
+        latency, worst = mean_latency(m, val_loader, args.latency_windows, device)
+        report[name] = {'accuracy': float((logits.argmax(dim=1) == labels).float().mean()),
+                        'mean_latency_ms': latency, 'max_latency_ms': worst}
+        logging.info('{}: val-acc {:.4f}, mean latency {:.2f} ms, max latency {:.2f} ms'.format(
+                     name, report[name]['accuracy'], latency, worst))
+    logging.info('Threshold {:.4f}: {:.2%} of the windows exit early, mean latency x{:.2f}'.format(
+                 report['threshold'], exit_rate,
+                 report['full']['mean_latency_ms'] / report['cascade']['mean_latency_ms']))
+
+    base_name = os.path.splitext(args.load_path)[0]
+    with open(base_name + '_cascade_report.json', 'w') as f:
+        json.dump(report, f, indent=4)
+    torch.save({'exit_kernels': exit_kernels, 'feature_size': feature_size, 'num_classes': args.num_classes,
+                'rank': args.head_rank, 'threshold': float(cascade.threshold), 'exit_head': exit_head.state_dict()},
+               base_name + '_cascade.pth')
+    logging.info('Auxiliary head saved to {}'.format(base_name + '_cascade.pth'))
+    logger.handlers.clear()
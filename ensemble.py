@@ -0,0 +1,102 @@
+'''
+Fused ensemble inference over several trained models (e.g. seeds or methods) and the heads of each of them.
+The models in --load_path (separated by ",", with one --model_name for all or one per path) are merged into an
+EnsembleModel (see inference_utils), which shares the backbone forward of members with the same backbone
+weights, stacks the heads of all members into one batched head, and evaluates independent backbones in one
+batched call when it is faster (--ensemble_backbones). The accuracy of every member and of the ensemble on the
+target validation set, and the latency of the fused ensemble against running the members one by one, are
+written to a report.
+
+Example: Ensemble three seeds of DANN and an MCD model trained from CWRU operation condition 0 to condition 1.
+python ensemble.py --model_name DANN,DANN,DANN,MCD --load_path ./ckpt/DANN/single_source/1.pth,./ckpt/DANN/single_source/2.pth,./ckpt/DANN/single_source/3.pth,./ckpt/MCD/single_source/1.pth --source CWRU_0 --target CWRU_1
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import copy
+import json
+import torch
+import logging
+import torch.nn as nn
+import torch.nn.functional as F
+
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--ensemble_backbones', type=str, choices=['sequential', 'batched', 'auto'], default='auto',
+                        help='Evaluation of independent backbones of the same architecture ("auto" times both at the first forward pass)')
+    parser.add_argument('--latency_batch_sizes', type=str, default='1,64',
+                        help='Batch sizes to measure the latency, separated by ","')
+    parser.add_argument('--report_path', type=str, default='./ensemble_report.json', help='Path of the report')
+    args = parser.parse_args()
+    return args
+
+
+class SequentialEnsemble(nn.Module):
+    '''
+    Reference implementation: every member runs on its own and the softmax outputs are averaged.
+    '''
+    def __init__(self, members):
+        super(SequentialEnsemble, self).__init__()
+        self.members = nn.ModuleList(members)
+
+    def forward(self, input):
+        return torch.log(torch.stack([F.softmax(m(input), dim=-1) for m in self.members], dim=0).mean(dim=0))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    args = inference_utils.prepare_args(args)
+    paths = args.load_path.split(',')
+    names = args.model_name.split(',') if ',' in args.model_name else [args.model_name] * len(paths)
+    if len(names) != len(paths):
+        raise Exception("Give one model name for all paths or one per path.")
+
+    # The datasets of the first member
+    data_args = copy.copy(args)
+    data_args.model_name, data_args.load_path = names[0], paths[0]
+    trainer = inference_utils.build_trainer(data_args)
+    device, val_loader = trainer.device, trainer.dataloaders['val']
+
+    members = []
+    for name, path in zip(names, paths):
+        member_args = copy.copy(args)
+        member_args.model_name, member_args.load_path = name, path
+        members.append(inference_utils.load_inference_model(member_args, device))
+    fused = inference_utils.EnsembleModel(members, args.ensemble_backbones).to(device).eval()
+    sequential = SequentialEnsemble(members).eval()
+    logging.info('{} members, {} distinct backbones, {} heads ({})'.format(
+                 len(members), len(fused.Gs), len(fused.head_backbone),
+                 'stacked' if not isinstance(fused.heads, nn.ModuleList) else 'not stackable'))
+
+    report = {'members': []}
+    for name, path, member in zip(names, paths, members):
+        acc = inference_utils.evaluate(member, val_loader, device)
+        report['members'].append({'model_name': name, 'load_path': path, 'accuracy': acc})
+        logging.info('{} {}: val-acc {:.4f}'.format(name, path, acc))
+    report['accuracy'] = inference_utils.evaluate(fused, val_loader, device)
+    report['sequential_accuracy'] = inference_utils.evaluate(sequential, val_loader, device)
+    logging.info('Ensemble: val-acc {:.4f} (sequential {:.4f})'.format(report['accuracy'],
+                                                                       report['sequential_accuracy']))
+
+    example = next(iter(val_loader))[0]
+    for bs in [int(b) for b in args.latency_batch_sizes.split(',')]:
+        input = torch.randn(bs, *example.shape[1:], device=device)
+        with torch.no_grad():
+            report['max_logit_difference_bs%d' % bs] = float((fused(input) - sequential(input)).abs().max())
+        report['latency_ms_bs%d' % bs] = {
+            'single': inference_utils.measure_latency(members[0], input, repeats=20),
+            'sequential': inference_utils.measure_latency(sequential, input, repeats=20),
+            'fused': inference_utils.measure_latency(fused, input, repeats=20)}
+        logging.info('Batch size {}: {:.2f} ms fused, {:.2f} ms member by member, {:.2f} ms for one member'.format(
+                     bs, report['latency_ms_bs%d' % bs]['fused'], report['latency_ms_bs%d' % bs]['sequential'],
+                     report['latency_ms_bs%d' % bs]['single']))
+
+    with open(args.report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    logging.info('Report saved to {}'.format(args.report_path))
+    logger.handlers.clear()
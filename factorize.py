@@ -0,0 +1,84 @@
+'''
+Low-rank factorization of the classifiers and discriminators of a trained model.
+Every dense Linear layer of the ClassifierMLPs is replaced by a LowRankLinear initialized with the truncated
+SVD of its weights, when the factorization has fewer parameters. An optional fine-tuning recovers the
+accuracy lost by the truncation. The factorized checkpoint is saved in the format of the trainer, so it can
+be loaded or trained further with the same --head_rank.
+
+Example: Factorize the heads of an MCD model trained from CWRU operation condition 0 to condition 1.
+python factorize.py --model_name MCD --load_path ./ckpt/MCD/single_source/**.pth --source CWRU_0 --target CWRU_1 --svd_rank 64
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import copy
+import torch
+import logging
+import torch.nn as nn
+
+import model_base
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--svd_rank', type=int, default=64, help='Rank of the factorized Linear layers')
+    parser.add_argument('--factorize_epochs', type=int, default=0,
+                        help='Epochs of fine-tuning after the factorization (0 means no fine-tuning)')
+    parser.add_argument('--factorize_lr', type=float, default=1e-3,
+                        help='Learning rate of fine-tuning after the factorization')
+    args = parser.parse_args()
+    return args
+
+
+def factorize(module, rank):
+    '''
+    Replace the dense Linear layers of every ClassifierMLP and StackedClassifierMLP in module by truncated SVDs.
+    '''
+    for m in module.modules():
+        if not isinstance(m, (model_base.ClassifierMLP, model_base.StackedClassifierMLP)):
+            continue
+        for idx, fc in enumerate(m.net):
+            if isinstance(fc, (nn.Linear, model_base.StackedLinear)) and \
+               model_base.use_low_rank(fc.in_features, fc.out_features, rank):
+                m.net[idx] = model_base.LowRankLinear.from_linear(fc, rank)
+    return module
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    if args.random_state is not None:
+        torch.manual_seed(args.random_state)
+    args = inference_utils.prepare_args(args)
+
+    trainer = inference_utils.build_trainer(args)
+    model = inference_utils.get_inference_model(trainer)
+    original = copy.deepcopy(model)
+    device, val_loader = trainer.device, trainer.dataloaders['val']
+    example = next(iter(val_loader))[0].to(device)
+    features = model.G(example)
+    heads = lambda m: inference_utils.InferenceModel(nn.Identity(), m.heads, combine=m.combine)
+    networks = [m for m in vars(trainer).values() if isinstance(m, nn.Module)]
+
+    before = {'accuracy': inference_utils.evaluate(model, val_loader, device),
+              'parameters': sum([inference_utils.count_parameters(m) for m in networks]),
+              'latency_ms': inference_utils.measure_latency(heads(model), features)}
+    for m in networks:
+        factorize(m, args.svd_rank)
+    after = {'accuracy': inference_utils.evaluate(model, val_loader, device),
+             'parameters': sum([inference_utils.count_parameters(m) for m in networks]),
+             'latency_ms': inference_utils.measure_latency(heads(model), features)}
+    logging.info('Rank {}: val-acc {:.4f} -> {:.4f}, parameters {} -> {}, '
+                 'latency of the heads {:.2f} ms -> {:.2f} ms'.format(
+                 args.svd_rank, before['accuracy'], after['accuracy'], before['parameters'], after['parameters'],
+                 before['latency_ms'], after['latency_ms']))
+    if args.factorize_epochs > 0:
+        inference_utils.finetune(model, original, trainer, args.factorize_epochs, args.factorize_lr)
+        logging.info('Val-acc after fine-tuning: {:.4f}'.format(inference_utils.evaluate(model, val_loader, device)))
+
+    args.save_path = os.path.splitext(args.load_path)[0] + '_rank%d' % args.svd_rank
+    trainer.save_model()
+    logging.info('Load the factorized model with --head_rank {}'.format(args.svd_rank))
+    logger.handlers.clear()
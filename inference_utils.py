@@ -0,0 +1,486 @@
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import copy
+import time
+import torch
+import logging
+import importlib
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+
+import utils
+import model_base
+
+
+def setlogger():
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logFormatter = logging.Formatter("%(asctime)s %(message)s", "%m-%d %H:%M:%S")
+
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    logger.addHandler(consoleHandler)
+    return logger
+
+
+def prepare_args(args):
+    '''
+    Parse the source names and detect the fault classes of the target data in the same way as train.py.
+    '''
+    args.source_name = [x.strip() for x in list(args.source.split(','))]
+    if '' in args.source_name:
+        args.source_name.remove('')
+
+    if '_' in args.target:
+        tgt, condition = args.target.split('_')[0], int(args.target.split('_')[1])
+        data_root = os.path.join(args.data_dir, tgt)
+        args.faults = sorted(os.listdir(os.path.join(data_root, 'condition_%d' % condition)))
+    else:
+        data_root = os.path.join(args.data_dir, args.target)
+        args.faults = sorted(os.listdir(data_root))
+    args.num_classes = len(args.faults)
+    logging.info('Detect {} classes: {}'.format(args.num_classes, args.faults))
+    return args
+
+
+def get_normalization(input, norm_type):
+    '''
+    Scale and offset of each sample of input (batch, channels, length), with which it is normalized as in
+    aug.Normalize.
+    '''
+    x = input.flatten(1)
+    if norm_type == 'mean-std':
+        scale = 1 / x.std(dim=1, unbiased=False)
+        offset = -x.mean(dim=1) * scale
+    else:
+        low, high = x.min(dim=1)[0], x.max(dim=1)[0]
+        scale = 1 / (high - low)
+        offset = -low * scale
+        if norm_type == '-1-1':
+            scale, offset = 2 * scale, 2 * offset - 1
+    return scale.view(-1, 1, 1), offset.view(-1, 1, 1)
+
+
+def build_trainer(args, init_data=True):
+    '''
+    Build the trainer of args.model_name and load the weights in args.load_path.
+    init_data: Whether to build the datasets. If False, only the networks are built.
+    '''
+    Trainset = importlib.import_module(f"models.{args.model_name}").Trainset
+    if not init_data:
+        Trainset = type(Trainset.__name__, (Trainset,), {'_init_data': lambda self, *args, **kwargs: None})
+    trainer = Trainset(args)
+    # Some trainers (e.g. MSSA) only build the datasets when training starts
+    if init_data and not hasattr(trainer, 'dataloaders'):
+        trainer._init_data()
+    if args.load_path:
+        trainer.load_model()
+    return trainer
+
+
+def load_inference_model(args, device):
+    '''
+    Load args.load_path for inference: a trainer checkpoint (with the early exit of cascade.py if
+    args.cascade_path is set), a pruned model of prune.py or a TorchScript model of quantize.py (**.pt).
+    Several paths separated by "," (with one model name, or one per path) are loaded as an EnsembleModel.
+    '''
+    if ',' in args.load_path:
+        paths = args.load_path.split(',')
+        names = args.model_name.split(',') if ',' in args.model_name else [args.model_name] * len(paths)
+        members = []
+        for name, path in zip(names, paths):
+            member_args = copy.copy(args)
+            member_args.model_name, member_args.load_path, member_args.cascade_path = name, path, ''
+            members.append(load_inference_model(member_args, device))
+        return EnsembleModel(members, getattr(args, 'ensemble_backbones', 'auto')).to(device).eval()
+    if args.load_path.endswith('.pt'):
+        return torch.jit.load(args.load_path, map_location=device).eval()
+    ckpt = torch.load(args.load_path, map_location=device)
+    if 'config' in ckpt:
+        from prune import build_pruned_model
+        model = build_pruned_model(ckpt['config'])
+        model.load_state_dict(ckpt['model'])
+        return model.to(device).eval()
+    model = get_inference_model(build_trainer(args, init_data=False))
+    if getattr(args, 'cascade_path', ''):
+        from cascade import load_cascade
+        model = load_cascade(model, args.cascade_path)
+    return model.eval()
+
+
+class InferenceModel(nn.Module):
+    '''
+    Feature extractor followed by the classifier heads used by a trainer at test time.
+    heads: A list of classifiers or a StackedClassifierMLP.
+    combine: How to merge the heads, 'sum' adds the logits (MCD) and 'softmax' averages
+             the softmax outputs (MSSA, MFSAN, ADACL). The output is always logits.
+    '''
+    def __init__(self, G, heads, combine='sum'):
+        super(InferenceModel, self).__init__()
+        self.G = G
+        self.heads = heads if isinstance(heads, model_base.StackedClassifierMLP) else nn.ModuleList(heads)
+        self.combine = combine
+
+    def forward(self, input):
+        return self.classify(self.G(input))
+
+    def classify(self, f):
+        '''
+        Merged logits of the heads from the features of G.
+        '''
+        if isinstance(self.heads, model_base.StackedClassifierMLP):
+            y = self.heads(f)
+        elif len(self.heads) == 1:
+            return self.heads[0](f)
+        else:
+            y = torch.stack([C(f) for C in self.heads], dim=0)
+        if len(self.heads) == 1:
+            return y[0]
+        if self.combine == 'sum':
+            return y.sum(dim=0)
+        return torch.log(F.softmax(y, dim=-1).mean(dim=0))
+
+
+def get_inference_model(trainer):
+    '''
+    Collect the networks of a trainer into an InferenceModel.
+    '''
+    if hasattr(trainer, 'model'):
+        model = trainer.model
+        if isinstance(model, nn.Sequential):
+            G, heads = model[0], [model[1]]
+        elif hasattr(model, 'C'):
+            G, heads = model.G, [model.C]
+        else:
+            G, heads = model.G, [model.C1]
+        combine = 'sum'
+    elif hasattr(trainer, 'Cs'):
+        G = trainer.G if hasattr(trainer, 'G') else trainer.G_shared
+        heads, combine = trainer.Cs, 'softmax'
+    elif hasattr(trainer, 'C1'):
+        G, heads, combine = trainer.G, [trainer.C1, trainer.C2], 'sum'
+    else:
+        G, heads, combine = trainer.G, [trainer.C], 'sum'
+    return InferenceModel(G, heads, combine=combine).eval()
+
+
+def stack_heads(heads):
+    '''
+    One StackedClassifierMLP with the weights of a list of ClassifierMLPs and StackedClassifierMLPs (without
+    last layer), or None if their architectures differ or they have factorized layers.
+    '''
+    layers = [[], [], []]
+    for C in heads:
+        if not isinstance(C, (model_base.ClassifierMLP, model_base.StackedClassifierMLP)) or C.last is not None:
+            return None
+        for i, idx in enumerate([1, 3, 5]):
+            fc = C.net[idx]
+            if isinstance(fc, nn.Linear):
+                layers[i].append((fc.weight.t().unsqueeze(0), fc.bias.unsqueeze(0)))
+            elif isinstance(fc, model_base.StackedLinear):
+                layers[i].append((fc.weight, fc.bias))
+            else:
+                return None
+    for layer in layers:
+        if len(set([w.shape[1:] for w, _ in layer])) > 1:
+            return None
+    weight = [torch.cat([w for w, _ in layer], dim=0) for layer in layers]
+    stacked = model_base.StackedClassifierMLP(len(weight[0]), weight[0].shape[1], weight[2].shape[2], 0.,
+                                              last=None).to(weight[0].device)
+    with torch.no_grad():
+        for idx, layer, w in zip([1, 3, 5], layers, weight):
+            stacked.net[idx].weight.copy_(w)
+            stacked.net[idx].bias.copy_(torch.cat([b for _, b in layer], dim=0))
+    return stacked.eval()
+
+
+def same_weights(a, b):
+    '''
+    Whether two modules are the same or have the same architecture and weights.
+    '''
+    if a is b:
+        return True
+    sa, sb = a.state_dict(), b.state_dict()
+    return str(a) == str(b) and sa.keys() == sb.keys() and \
+           all([sa[k].shape == sb[k].shape and torch.equal(sa[k], sb[k]) for k in sa])
+
+
+class EnsembleModel(nn.Module):
+    '''
+    Mean of the softmax outputs of several models (e.g. seeds or methods) evaluated jointly. Each member merges
+    its own heads as an InferenceModel, members with the same backbone weights share one forward of it, and the
+    heads of all members are stacked into one StackedClassifierMLP when their architectures allow it.
+    backbones: How independent backbones of the same architecture are evaluated, 'sequential', 'batched'
+               (one vmap call over their stacked weights) or 'auto' (the faster one, timed at the first forward
+               pass of each input shape).
+    Other members (e.g. TorchScript models or cascades) run on their own. The output is logits.
+    '''
+    def __init__(self, members, backbones='auto'):
+        super(EnsembleModel, self).__init__()
+        assert backbones in ['sequential', 'batched', 'auto'], f"backbones should be 'sequential', 'batched' or 'auto', but got {backbones}"
+        Gs, heads, others = [], [], []
+        # Backbone of every head and of every head module (a StackedClassifierMLP has several heads)
+        head_backbone, module_backbone = [], []
+        # (combine, first head, number of heads) of each InferenceModel, or (None, index in others, 1)
+        self.specs = []
+        for model in members:
+            if not isinstance(model, InferenceModel):
+                self.specs.append((None, len(others), 1))
+                others.append(model)
+                continue
+            b = [i for i, G in enumerate(Gs) if same_weights(G, model.G)]
+            if b:
+                b = b[0]
+            else:
+                b = len(Gs)
+                Gs.append(model.G)
+            count = len(model.heads)
+            self.specs.append((model.combine, len(head_backbone), count))
+            modules = [model.heads] if isinstance(model.heads, model_base.StackedClassifierMLP) else list(model.heads)
+            heads.extend(modules)
+            module_backbone.extend([b] * len(modules))
+            head_backbone.extend([b] * count)
+        self.Gs = nn.ModuleList(Gs)
+        self.others = nn.ModuleList(others)
+        stacked = stack_heads(heads) if heads else None
+        self.heads = stacked if stacked is not None else nn.ModuleList(heads)
+        self.register_buffer('head_backbone', torch.tensor(head_backbone, dtype=torch.long))
+        self.module_backbone = module_backbone
+        self.backbones = backbones
+        # The batched call needs backbones with the same architecture
+        self.batchable = len(Gs) > 1 and all([str(G) == str(Gs[0]) for G in Gs])
+        self._stacked_state, self._best = None, {}
+
+    def _batched_features(self, input):
+        from torch.func import stack_module_state, functional_call, vmap
+        device = input.device
+        if self._stacked_state is None or self._stacked_state[0] != device:
+            params, buffers = stack_module_state(list(self.Gs))
+            self._stacked_state = (device, params, buffers)
+        _, params, buffers = self._stacked_state
+        G = self.Gs[0]
+        return vmap(lambda p, b, x: functional_call(G, (p, b), (x,)), in_dims=(0, 0, None))(params, buffers, input)
+
+    def _sequential_features(self, input):
+        return torch.stack([G(input) for G in self.Gs], dim=0)
+
+    def features(self, input):
+        '''
+        Features of every distinct backbone, (backbones, batch, features).
+        '''
+        if not self.batchable or self.backbones == 'sequential':
+            return self._sequential_features(input)
+        if self.backbones == 'batched':
+            return self._batched_features(input)
+        key = (tuple(input.shape), input.device.type)
+        if key not in self._best:
+            times = {}
+            for name, run in [('sequential', self._sequential_features), ('batched', self._batched_features)]:
+                run(input)
+                start = time.perf_counter()
+                run(input)
+                times[name] = time.perf_counter() - start
+            self._best[key] = min(times, key=times.get)
+            logging.info('Ensemble backbones for input {}: {}'.format(key[0], self._best[key]))
+        if self._best[key] == 'batched':
+            return self._batched_features(input)
+        return self._sequential_features(input)
+
+    def forward(self, input):
+        if len(self.Gs) > 0:
+            f = self.features(input)
+            if isinstance(self.heads, model_base.StackedClassifierMLP):
+                y = self.heads(f[self.head_backbone])
+            else:
+                y = torch.cat([C(f[b]) if isinstance(C, model_base.StackedClassifierMLP) else C(f[b]).unsqueeze(0)
+                               for C, b in zip(self.heads, self.module_backbone)], dim=0)
+        logits = []
+        for combine, start, count in self.specs:
+            if combine is None:
+                logits.append(self.others[start](input))
+            elif count == 1:
+                logits.append(y[start])
+            elif combine == 'sum':
+                logits.append(y[start:start+count].sum(dim=0))
+            else:
+                logits.append(torch.log(F.softmax(y[start:start+count], dim=-1).mean(dim=0)))
+        if len(logits) == 1:
+            return logits[0]
+        return torch.log(torch.stack([F.softmax(l, dim=-1) for l in logits], dim=0).mean(dim=0))
+
+
+def has_dropout(module):
+    return any([isinstance(m, nn.Dropout) and m.p > 0 for m in module.modules()])
+
+
+def predictive_uncertainty(p):
+    '''
+    Predictive mean, entropy and mutual information of the class probabilities p (samples, batch, classes).
+    '''
+    mean = p.mean(dim=0)
+    entropy = -torch.special.xlogy(mean, mean).sum(dim=-1)
+    expected_entropy = -torch.special.xlogy(p, p).sum(dim=-1).mean(dim=0)
+    return mean, entropy, (entropy - expected_entropy).clamp(min=0)
+
+
+class MCDropoutModel(nn.Module):
+    '''
+    Monte-Carlo dropout over an InferenceModel: num_samples stochastic passes with the dropout layers active and
+    the rest in eval mode, evaluated as one batched forward. Each branch runs its layers before its first dropout
+    layer once, and only the following layers and the heads run on num_samples copies of the batch.
+    The output is the log of the predictive mean, see predict() for the uncertainty.
+    '''
+    def __init__(self, model, num_samples=20):
+        super(MCDropoutModel, self).__init__()
+        if not isinstance(model, InferenceModel):
+            raise Exception("MC dropout needs a trainer checkpoint, not a {}.".format(type(model).__name__))
+        if not has_dropout(model):
+            raise Exception("The model has no dropout layer, train it with --dropout > 0 for MC dropout.")
+        self.model = model
+        self.num_samples = num_samples
+        # Index of the first layer with dropout in every branch (len(fs) if none)
+        self.splits = []
+        for conv in model.G.convs:
+            idx = [i for i, layer in enumerate(conv.fs) if has_dropout(layer)]
+            self.splits.append(idx[0] if idx else len(conv.fs))
+
+    def _set_stochastic(self, mode):
+        # A StackedClassifierMLP in training mode draws the dropout masks of every head independently
+        for m in self.model.modules():
+            if isinstance(m, (nn.Dropout, model_base.StackedClassifierMLP)):
+                m.train(mode)
+
+    def _replicate(self, x):
+        return x.unsqueeze(0).expand(self.num_samples, *x.shape).flatten(0, 1)
+
+    def sample(self, input):
+        '''
+        Class probabilities of every stochastic pass, (num_samples, batch, classes).
+        '''
+        G = self.model.G
+        out = []
+        try:
+            for conv, x, split in zip(G.convs, G.branch_inputs(input), self.splits):
+                x = conv.fs[:split](x)
+                self._set_stochastic(True)
+                out.append(conv.fs[split:](self._replicate(x)))
+                self._set_stochastic(False)
+            self._set_stochastic(True)
+            y = self.model.classify(G.fl(torch.cat(out, dim=1)))
+        finally:
+            self._set_stochastic(False)
+        return F.softmax(y.view(self.num_samples, input.shape[0], -1), dim=-1)
+
+    def sample_sequential(self, input):
+        '''
+        Same as sample() with num_samples full forward passes, as a reference.
+        '''
+        try:
+            self._set_stochastic(True)
+            return torch.stack([F.softmax(self.model(input), dim=-1) for _ in range(self.num_samples)], dim=0)
+        finally:
+            self._set_stochastic(False)
+
+    def predict(self, input):
+        '''
+        Predictive mean (batch, classes), predictive entropy and mutual information between the prediction and
+        the weights (batch), which is the part of the entropy due to the model uncertainty.
+        '''
+        return predictive_uncertainty(self.sample(input))
+
+    def forward(self, input):
+        return torch.log(self.sample(input).mean(dim=0))
+
+
+def evaluate(model, dataloader, device):
+    '''
+    Accuracy of the model on a dataloader, averaged over batches as in the test() of the trainers.
+    '''
+    model.eval()
+    acc = 0.0
+    num_iter = len(dataloader)
+    with torch.no_grad():
+        for data, labels, _ in dataloader:
+            data, labels = data.to(device), labels.to(device)
+            acc += utils.get_accuracy(model(data), labels)
+    return acc / num_iter
+
+
+def measure_latency(model, input, repeats=50, warmup=5):
+    '''
+    Median wall-clock time in milliseconds of a forward pass (of a module or a function).
+    '''
+    if isinstance(model, nn.Module):
+        model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            model(input)
+            if input.is_cuda:
+                torch.cuda.synchronize()
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def finetune(model, teacher, trainer, epochs, lr):
+    '''
+    Briefly fine-tune a compressed model. Labelled source data keep the classifier accurate, while
+    the soft labels of the original model (teacher) on target data keep the adapted behaviour.
+    '''
+    args = trainer.args
+    teacher.eval()
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=lr, momentum=args.momentum)
+    for epoch in range(1, epochs+1):
+        model.train()
+        epoch_loss = 0.0
+        num_iter = len(trainer.dataloaders['train'])
+        for i in range(num_iter):
+            target_data, _ = utils.get_next_batch(trainer.dataloaders, trainer.iters, 'train', trainer.device)
+            source_data, source_labels = utils.get_next_batch(trainer.dataloaders, trainer.iters,
+                                                              args.source_name, trainer.device)
+            with torch.no_grad():
+                soft_labels = F.softmax(teacher(target_data), dim=1)
+            optimizer.zero_grad()
+            loss = F.cross_entropy(model(source_data), source_labels) + \
+                   F.kl_div(F.log_softmax(model(target_data), dim=1), soft_labels, reduction='batchmean')
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item()
+        logging.info('Fine-tune epoch {}/{} loss: {:.4f}'.format(epoch, epochs, epoch_loss/num_iter))
+    return model.eval()
+
+
+def count_parameters(model):
+    return sum([p.numel() for p in model.parameters()])
+
+
+def count_flops(model, input):
+    '''
+    Multiply-accumulate operations of the Conv1d and Linear layers for one sample.
+    '''
+    flops = []
+    def hook(module, input, output):
+        if isinstance(module, nn.Conv1d):
+            flops.append(output[0].numel() * module.in_channels // module.groups * module.kernel_size[0])
+        else:
+            flops.append(module.in_features * module.out_features)
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv1d, nn.Linear))]
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(input[:1])
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def model_size(path):
+    '''
+    Size of a saved model file in MB.
+    '''
+    return os.path.getsize(path) / 2**20
@@ -0,0 +1,82 @@
+'''
+Speed and variance of the MK-MMD estimators (--mmd_estimator of opt.py) for large batches.
+Source and target features are drawn from two shifted distributions of --feature_dim features. For every batch
+size, each estimator reports the median time of a forward and backward pass, and the mean and standard
+deviation of its estimate over --repeats independent batches (and random features for "rff").
+The quadratic estimator uses --mmd_tile_size, which it needs for the largest batches.
+
+Example:
+python mmd_benchmark.py --batch_sizes 64,256,1024,4096 --mmd_tile_size 1024
+'''
+import sys
+sys.path.extend(['./models', './data_loader'])
+import json
+import time
+import torch
+import logging
+import numpy as np
+
+import utils
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--batch_sizes', type=str, default='64,256,1024,4096',
+                        help='Batch sizes of each domain, separated by ","')
+    parser.add_argument('--estimators', type=str, default='quadratic,linear_time,rff',
+                        help='Estimators to compare, separated by ","')
+    parser.add_argument('--feature_dim', type=int, default=2560, help='Number of features')
+    parser.add_argument('--repeats', type=int, default=10, help='Number of batches to estimate the variance')
+    parser.add_argument('--report_path', type=str, default='./mmd_benchmark.json', help='Path of the report')
+    args = parser.parse_args()
+    return args
+
+
+def sample(batch_size, dim, device):
+    # Non-negative features as after the ReLU and pooling of the backbone, with a shift between the domains
+    z_s = torch.relu(torch.randn(batch_size, dim, device=device) + 0.5)
+    z_t = torch.relu(1.2 * torch.randn(batch_size, dim, device=device) + 0.6)
+    return z_s, z_t
+
+
+def build(args, estimator):
+    return utils.MultipleKernelMaximumMeanDiscrepancy(
+        kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+        tile_size=args.mmd_tile_size, estimator=estimator, num_features=args.mmd_features)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    torch.manual_seed(args.random_state)
+    device = torch.device("cuda:" + args.cuda_device) if args.cuda_device else torch.device("cpu")
+
+    report = []
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        for estimator in args.estimators.split(','):
+            mkmmd = build(args, estimator)
+            z_s, z_t = sample(batch_size, args.feature_dim, device)
+            z_s.requires_grad_(True)
+            times = []
+            for i in range(3):
+                start = time.perf_counter()
+                mkmmd(z_s, z_t).backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                times.append((time.perf_counter() - start) * 1000)
+            estimates = []
+            with torch.no_grad():
+                for _ in range(args.repeats):
+                    mkmmd = build(args, estimator)
+                    estimates.append(float(mkmmd(*sample(batch_size, args.feature_dim, device))))
+            report.append({'batch_size': batch_size, 'estimator': estimator, 'time_ms': float(np.median(times)),
+                           'mean': float(np.mean(estimates)), 'std': float(np.std(estimates))})
+            logging.info('B={} {}: {:.1f} ms forward and backward, estimate {:.4f} +- {:.4f}'.format(
+                         batch_size, estimator, report[-1]['time_ms'], report[-1]['mean'], report[-1]['std']))
+
+    with open(args.report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    logging.info('Report saved to {}'.format(args.report_path))
+    logger.handlers.clear()
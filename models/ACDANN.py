@@ -21,12 +21,15 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         output_size = 2560
-        self.discriminator = model_base.ClassifierMLP(input_size=args.num_classes*output_size, output_size=2,
-                        dropout=args.dropout, last=None).to(self.device)
+        self.map = utils.get_multilinear_map(args.multilinear, output_size, args.num_classes,
+                                             args.multilinear_dim).to(self.device)
+        self.discriminator = model_base.ClassifierMLP(input_size=self.map.output_dim, output_size=2,
+                        dropout=args.dropout, last=None, rank=args.head_rank).to(self.device)
         self.grl = utils.GradientReverseLayer()
         self.dist_beta = torch.distributions.beta.Beta(1., 1.)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                          dropout=args.dropout).to(self.device)
+                                          dropout=args.dropout, rank=args.head_rank,
+                                          **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -37,7 +40,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -50,7 +53,7 @@ class Trainset(InitTrain):
         elif args.train_mode == 'multi_source':
             raise Exception("This model cannot be trained in multi_source mode.")
         
-        self.optimizer = self._get_optimizer([self.model, self.discriminator])
+        self.optimizer = self._get_optimizer([self.model, self.discriminator, self.map])
         self.lr_scheduler = self._get_lr_scheduler(self.optimizer)
         
         best_acc = 0.0
@@ -104,12 +107,9 @@ class Trainset(InitTrain):
                 softmax_output_src = lmb * softmax_output_src + (1.-lmb) * softmax_output_src[idxx]
                 softmax_output_tgt = lmb * softmax_output_tgt + (1.-lmb) * softmax_output_tgt[idxx]
                                              
-                feat_src_ = torch.bmm(softmax_output_src.unsqueeze(2),
-                                     f_s.unsqueeze(1)).view(batch_size, -1)
-                feat_tgt_ = torch.bmm(softmax_output_tgt.unsqueeze(2),
-                                     f_t.unsqueeze(1)).view(batch_size, -1)
-    
-                feat = self.grl(torch.concat((feat_src_, feat_tgt_), dim=0))
+                # The map is bilinear, so reversing the gradients of both inputs equals reversing that of the output
+                feat = self.map(self.grl(torch.concat((f_s, f_t), dim=0)),
+                                self.grl(torch.concat((softmax_output_src, softmax_output_tgt), dim=0)))
                 logits_dm = self.discriminator(feat)
                 loss_dm = F.cross_entropy(logits_dm, labels_dm)
                 loss = loss_c + tradeoff[0] * loss_dm
@@ -17,16 +17,48 @@ from train_utils import InitTrain
 
 
 class BatchSpectralPenalizationLoss(nn.Module):
-
-    def __init__(self,  bsp_tradeoff):
+    '''
+    Sum of the squares of the k largest singular values of the source and of the target features.
+    solver: 'svd' takes them from the full SVD. 'power' runs power_iters steps of subspace iteration from the top
+            right singular vectors of the previous step (which change slowly, since they live in the feature
+            space), initialized by torch.svd_lowrank. 'lowrank' uses torch.svd_lowrank at every step.
+    With 'power' and 'lowrank', the singular vectors V are found without gradients and the penalty is |F V|_F^2,
+    whose gradient 2 F V V^T is the gradient of the sum of the squared singular values.
+    '''
+    def __init__(self,  bsp_tradeoff, k=1, solver='power', power_iters=2):
         super(BatchSpectralPenalizationLoss, self).__init__()
         
         self.bsp_tradeoff= bsp_tradeoff
+        assert solver in ['svd', 'power', 'lowrank'], f"solver should be 'svd', 'power' or 'lowrank', but got {solver}"
+        self.k = k
+        self.solver = solver
+        self.power_iters = power_iters
+        # Top right singular vectors of the source and target features of the last step
+        self.vectors = [None, None]
+
+    def _top_vectors(self, f, idx):
+        with torch.no_grad():
+            f = f.detach()
+            v = self.vectors[idx]
+            if self.solver == 'lowrank' or v is None or v.shape[0] != f.size(1) or v.device != f.device:
+                _, _, v = torch.svd_lowrank(f, q=min(self.k + 6, *f.shape), niter=4)
+                v = v[:, :self.k]
+                if self.solver == 'lowrank':
+                    return v
+            v = v.to(f.dtype)
+            for _ in range(self.power_iters):
+                v = torch.linalg.qr(torch.mm(f.t(), torch.mm(f, v))).Q
+            self.vectors[idx] = v
+            return v
 
     def forward(self, f_s, f_t):
-        _, s_s, _ = torch.svd(f_s)
-        _, s_t, _ = torch.svd(f_t)
-        loss = torch.pow(s_s[0], 2) + torch.pow(s_t[0], 2)
+        if self.solver == 'svd':
+            _, s_s, _ = torch.svd(f_s)
+            _, s_t, _ = torch.svd(f_t)
+            loss = torch.pow(s_s[:self.k], 2).sum() + torch.pow(s_t[:self.k], 2).sum()
+        else:
+            loss = torch.mm(f_s, self._top_vectors(f_s, 0)).pow(2).sum() + \
+                   torch.mm(f_t, self._top_vectors(f_t, 1)).pow(2).sum()
         return self.bsp_tradeoff * loss
 
 
@@ -36,12 +68,14 @@ class Trainset(InitTrain):
         super(Trainset, self).__init__(args)
         output_size = 2560
         self.domain_discri = model_base.ClassifierMLP(input_size=output_size, output_size=1,
-                        dropout=args.dropout, last='sigmoid').to(self.device)
+                        dropout=args.dropout, last='sigmoid', rank=args.head_rank).to(self.device)
         grl = utils.GradientReverseLayer() 
         self.domain_adv = utils.DomainAdversarialLoss(self.domain_discri, grl=grl)
-        self.bsp = BatchSpectralPenalizationLoss(bsp_tradeoff=2e-4)
+        self.bsp = BatchSpectralPenalizationLoss(bsp_tradeoff=2e-4, k=args.bsp_k, solver=args.bsp_solver,
+                                                 power_iters=args.bsp_power_iters)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                     dropout=args.dropout).to(self.device)
+                                     dropout=args.dropout, rank=args.head_rank,
+                                     **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -52,7 +86,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -8,7 +8,6 @@ import logging
 from tqdm import tqdm
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 from collections import defaultdict
 
 import utils
@@ -27,38 +26,12 @@ def entropy(predictions: torch.Tensor, reduction='none') -> torch.Tensor:
         return H
 
 
-class RandomizedMultiLinearMap(nn.Module):
-
-    def __init__(self, features_dim: int, num_classes: int, output_dim: int = 1024):
-        super(RandomizedMultiLinearMap, self).__init__()
-        self.Rf = torch.randn(features_dim, output_dim)
-        self.Rg = torch.randn(num_classes, output_dim)
-        self.output_dim = output_dim
-
-    def forward(self, f: torch.Tensor, g: torch.Tensor) -> torch.Tensor:
-        f = torch.mm(f, self.Rf.to(f.device))
-        g = torch.mm(g, self.Rg.to(g.device))
-        output = torch.mul(f, g) / np.sqrt(float(self.output_dim))
-        return output
-
-
-class MultiLinearMap(nn.Module):
-
-    def __init__(self):
-        super(MultiLinearMap, self).__init__()
-
-    def forward(self, f: torch.Tensor, g: torch.Tensor) -> torch.Tensor:
-        batch_size = f.size(0)
-        output = torch.bmm(g.unsqueeze(2), f.unsqueeze(1))
-        return output.view(batch_size, -1)
-    
-
 class ConditionalDomainAdversarialLoss(nn.Module):
    
     def __init__(self, domain_discriminator: nn.Module, entropy_conditioning: bool = False,
                  randomized: bool = False, num_classes: int = -1,
                  features_dim: int = -1, randomized_dim: int = 1024,
-                 reduction: str = 'mean', sigmoid=True, grl = None):
+                 reduction: str = 'mean', sigmoid=True, grl = None, multilinear_map: nn.Module = None):
         super(ConditionalDomainAdversarialLoss, self).__init__()
         self.domain_discriminator = domain_discriminator
         self.grl = utils.WarmStartGradientReverseLayer(alpha=1., lo=0., hi=1., max_iters=1000, auto_step=True) \
@@ -67,11 +40,13 @@ class ConditionalDomainAdversarialLoss(nn.Module):
         self.sigmoid = sigmoid
         self.reduction = reduction
 
-        if randomized:
+        if multilinear_map is not None:
+            self.map = multilinear_map
+        elif randomized:
             assert num_classes > 0 and features_dim > 0 and randomized_dim > 0
-            self.map = RandomizedMultiLinearMap(features_dim, num_classes, randomized_dim)
+            self.map = utils.RandomizedMultiLinearMap(features_dim, num_classes, randomized_dim)
         else:
-            self.map = MultiLinearMap()
+            self.map = utils.MultiLinearMap(features_dim, num_classes)
         self.bce = lambda input, target, weight: F.binary_cross_entropy(input, target, weight,
                                                                         reduction=reduction) if self.entropy_conditioning \
             else F.binary_cross_entropy(input, target, reduction=reduction)
@@ -81,7 +56,9 @@ class ConditionalDomainAdversarialLoss(nn.Module):
         f = torch.cat((f_s, f_t), dim=0)
         g = torch.cat((g_s, g_t), dim=0)
         g = F.softmax(g, dim=1).detach()
-        h = self.grl(self.map(f, g))
+        # The map is linear in f, so reversing the gradient of f equals reversing that of the map output,
+        # while the learned parameters of a factorized map are trained with the discriminator
+        h = self.map(self.grl(f), g)
         d = self.domain_discriminator(h)
 
         weight = 1.0 + torch.exp(-entropy(g))
@@ -114,12 +91,16 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         output_size = 2560
-        self.domain_discri = model_base.ClassifierMLP(input_size=output_size * args.num_classes, output_size=1,
-                        dropout=args.dropout, last='sigmoid').to(self.device)
+        multilinear_map = utils.get_multilinear_map(args.multilinear, output_size, args.num_classes,
+                                                    args.multilinear_dim).to(self.device)
+        self.domain_discri = model_base.ClassifierMLP(input_size=multilinear_map.output_dim, output_size=1,
+                        dropout=args.dropout, last='sigmoid', rank=args.head_rank).to(self.device)
         grl = utils.GradientReverseLayer() 
-        self.domain_adv = ConditionalDomainAdversarialLoss(self.domain_discri, grl=grl)
+        self.domain_adv = ConditionalDomainAdversarialLoss(self.domain_discri, grl=grl,
+                                                           multilinear_map=multilinear_map)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                      dropout=args.dropout).to(self.device)
+                                      dropout=args.dropout, rank=args.head_rank,
+                                      **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -130,7 +111,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -143,7 +124,7 @@ class Trainset(InitTrain):
         elif args.train_mode == 'multi_source':
             raise Exception("This model cannot be trained with multi-source data.")
 
-        self.optimizer = self._get_optimizer([self.model, self.domain_discri])
+        self.optimizer = self._get_optimizer([self.model, self.domain_discri, self.domain_adv.map])
         self.lr_scheduler = self._get_lr_scheduler(self.optimizer)
         
         best_acc = 0.0
@@ -18,20 +18,57 @@ from train_utils import InitTrain
 
 
 class CorrelationAlignmentLoss(nn.Module):
-
-    def __init__(self):
+    '''
+    Mean squared differences of the means and of the covariance matrices of the source and target features.
+    The covariance difference is computed from the (batch, batch) Gram matrices of the centered features, since
+    |C_s - C_t|_F^2 = |X_s X_s^T|_F^2 / (n_s-1)^2 + |X_t X_t^T|_F^2 / (n_t-1)^2 - 2 |X_s X_t^T|_F^2 / ((n_s-1)(n_t-1)),
+    so the (features, features) covariance matrices are never built.
+    momentum: If positive, the covariances are running averages over the steps, in which the current batch has
+              the weight momentum, which reduces the noise of the estimates from small batches. They are stored
+              as sketches C W with a fixed random projection W of sketch_size columns, which estimate
+              |C_s - C_t|_F^2 by |C_s W - C_t W|_F^2, so the memory and cost are linear in the number of features.
+    '''
+    def __init__(self, momentum=0., sketch_size=256):
         super(CorrelationAlignmentLoss, self).__init__()
+        self.momentum = momentum
+        self.sketch_size = sketch_size
+        self.projection = None
+        self.running = None
+
+    def _gram_cov_diff(self, cent_s, cent_t):
+        ns, nt = len(cent_s) - 1, len(cent_t) - 1
+        diff = torch.mm(cent_s, cent_s.t()).pow(2).sum() / (ns * ns) \
+               + torch.mm(cent_t, cent_t.t()).pow(2).sum() / (nt * nt) \
+               - 2 * torch.mm(cent_s, cent_t.t()).pow(2).sum() / (ns * nt)
+        return diff / cent_s.size(1) ** 2
+
+    def _running_cov_diff(self, cent_s, cent_t):
+        dim = cent_s.size(1)
+        if self.projection is None or self.projection.shape[0] != dim or self.projection.device != cent_s.device:
+            # E[W W^T] = I, so that E|A W|_F^2 = |A|_F^2
+            self.projection = torch.randn(dim, self.sketch_size, device=cent_s.device) / self.sketch_size ** 0.5
+            self.running = None
+        W = self.projection.to(cent_s.dtype)
+        sketch_s = torch.mm(cent_s.t(), torch.mm(cent_s, W)) / (len(cent_s) - 1)
+        sketch_t = torch.mm(cent_t.t(), torch.mm(cent_t, W)) / (len(cent_t) - 1)
+        if self.running is not None:
+            sketch_s = torch.lerp(self.running[0], sketch_s, self.momentum)
+            sketch_t = torch.lerp(self.running[1], sketch_t, self.momentum)
+        if self.training:
+            self.running = (sketch_s.detach(), sketch_t.detach())
+        return (sketch_s - sketch_t).pow(2).sum() / dim ** 2
 
     def forward(self, f_s: torch.Tensor, f_t: torch.Tensor) -> torch.Tensor:
         mean_s = f_s.mean(0, keepdim=True)
         mean_t = f_t.mean(0, keepdim=True)
         cent_s = f_s - mean_s
         cent_t = f_t - mean_t
-        cov_s = torch.mm(cent_s.t(), cent_s) / (len(f_s) - 1)
-        cov_t = torch.mm(cent_t.t(), cent_t) / (len(f_t) - 1)
 
         mean_diff = (mean_s - mean_t).pow(2).mean()
-        cov_diff = (cov_s - cov_t).pow(2).mean()
+        if self.momentum > 0:
+            cov_diff = self._running_cov_diff(cent_s, cent_t)
+        else:
+            cov_diff = self._gram_cov_diff(cent_s, cent_t)
 
         return mean_diff + cov_diff
 
@@ -41,9 +78,10 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         
-        self.coral = CorrelationAlignmentLoss()
+        self.coral = CorrelationAlignmentLoss(momentum=args.coral_momentum, sketch_size=args.coral_sketch_size)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                      dropout=args.dropout).to(self.device)
+                                      dropout=args.dropout, rank=args.head_rank,
+                                      **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -54,7 +92,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -19,9 +19,11 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         self.mkmmd = utils.MultipleKernelMaximumMeanDiscrepancy(
-                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)])
+                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+                    **self._get_mkmmd_kwargs())
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                      dropout=args.dropout).to(self.device)
+                                      dropout=args.dropout, rank=args.head_rank,
+                                      **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -32,7 +34,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -20,9 +20,10 @@ class Trainset(InitTrain):
         super(Trainset, self).__init__(args)
         output_size = 2560
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                     dropout=args.dropout).to(self.device)
+                                     dropout=args.dropout, rank=args.head_rank,
+                                     **self._get_backbone_kwargs()).to(self.device)
         self.domain_discri = model_base.ClassifierMLP(input_size=output_size, output_size=1,
-                        dropout=args.dropout, last='sigmoid').to(self.device)
+                        dropout=args.dropout, last='sigmoid', rank=args.head_rank).to(self.device)
         grl = utils.GradientReverseLayer() 
         self.domain_adv = utils.DomainAdversarialLoss(self.domain_discri, grl=grl)
         self._init_data()
@@ -35,7 +36,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -1,7 +1,6 @@
 import torch
 import logging
 from tqdm import tqdm
-import torch.nn.functional as F
 from collections import defaultdict
 
 import utils
@@ -18,7 +17,7 @@ class AutomaticUpdateDomainWeightModule(object):
         """Get domain weight to calculate final objective.
 
         Inputs:
-            - sampled_domain_idxes (list): sampled domain indexes in current mini-batch
+            - sampled_domain_idxes (tensor): sampled domain indexes in current mini-batch
 
         Shape:
             - sampled_domain_idxes: :math:`(D, )` where D means the number of sampled domains in current mini-batch
@@ -33,16 +32,14 @@ class AutomaticUpdateDomainWeightModule(object):
 
         Inputs:
             - sampled_domain_losses (tensor): loss of among sampled domains in current mini-batch
-            - sampled_domain_idxes (list): sampled domain indexes in current mini-batch
+            - sampled_domain_idxes (tensor): sampled domain indexes in current mini-batch
 
         Shape:
             - sampled_domain_losses: :math:`(D, )` where D means the number of sampled domains in current mini-batch
             - sampled_domain_idxes: :math:`(D, )`
         """
         sampled_domain_losses = sampled_domain_losses.detach()
-
-        for loss, idx in zip(sampled_domain_losses, sampled_domain_idxes):
-            self.domain_weight[idx] *= (self.eta * loss).exp()
+        self.domain_weight[sampled_domain_idxes] *= (self.eta * sampled_domain_losses).exp()
 
 
 class Trainset(InitTrain):
@@ -50,7 +47,8 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                       dropout=args.dropout).to(self.device)
+                                       dropout=args.dropout, rank=args.head_rank,
+                                       **self._get_backbone_kwargs()).to(self.device)
         self.domain_weight_module = AutomaticUpdateDomainWeightModule(num_domains=self.num_source,
                                        eta=1e-2, device=self.device)
         self._init_data()
@@ -63,7 +61,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -79,7 +77,7 @@ class Trainset(InitTrain):
         best_acc = 0.0
         best_epoch = 0
 
-        domain_idxes = list(range(self.num_source))
+        domain_idxes = torch.arange(self.num_source, device=self.device)
         for epoch in range(1, args.max_epoch+1):
             logging.info('-'*5 + 'Epoch {}/{}'.format(epoch, args.max_epoch) + '-'*5)
             
@@ -96,21 +94,15 @@ class Trainset(InitTrain):
         
             num_iter = len(self.dataloaders['train'])          
             for i in tqdm(range(num_iter), ascii=True):
-                source_data, source_labels = [], []
-                for idx in range(self.num_source):
-                    source_data_item, source_labels_item = utils.get_next_batch(self.dataloaders,
-                                                self.iters, src[idx], self.device)
-                    source_data.append(source_data_item)
-                    source_labels.append(source_labels_item)
+                source_data, source_labels, domain_idx = utils.get_multi_source_batch(self.dataloaders,
+                                                                     self.iters, src, self.device)
                 
                 # forward
-                cls_acc = 0
                 self.optimizer.zero_grad()
-                loss_per_domain = torch.zeros(self.num_source).to(self.device)
-                for idx in range(self.num_source):
-                    y_per_domain, _ = self.model(source_data[idx])
-                    loss_per_domain[idx] = F.cross_entropy(y_per_domain, source_labels[idx])
-                    cls_acc += utils.get_accuracy(y_per_domain, source_labels[idx]) / self.num_source
+                y, _ = self.model(source_data)
+                loss_per_domain, acc_per_domain = utils.per_domain_loss(y, source_labels, domain_idx,
+                                                                        self.num_source)
+                cls_acc = acc_per_domain.mean().item()
 
                 # update domain weight
                 self.domain_weight_module.update(loss_per_domain, domain_idxes)
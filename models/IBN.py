@@ -90,8 +90,10 @@ class Trainset(InitTrain):
         super(Trainset, self).__init__(args)
         output_size = 2560
         self.model = nn.Sequential(
-            model_base.FeatureExtractor(in_channel=1, block=IBNlayer, dropout=args.dropout),
-            model_base.ClassifierMLP(output_size, args.num_classes, args.dropout, last=None)).to(self.device)
+            model_base.FeatureExtractor(in_channel=1, block=IBNlayer, dropout=args.dropout,
+                                        **self._get_backbone_kwargs()),
+            model_base.ClassifierMLP(output_size, args.num_classes, args.dropout, last=None,
+                                     rank=args.head_rank)).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -102,7 +104,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -16,17 +16,24 @@ from train_utils import InitTrain
 
 
 class InvariancePenaltyLoss(nn.Module):
-
+    '''
+    Product of the gradients of the cross-entropy of two halves of the samples of every domain with respect to
+    a scale of the logits at 1, averaged over the domains. The gradient has the closed form
+    mean(sum_c softmax(y)_c * y_c - y_label), so the penalty needs no second-order graph.
+    '''
     def __init__(self):
         super(InvariancePenaltyLoss, self).__init__()
-        self.scale = torch.tensor(1.).requires_grad_()
 
-    def forward(self, y: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
-        loss_1 = F.cross_entropy(y[::2] * self.scale, labels[::2])
-        loss_2 = F.cross_entropy(y[1::2] * self.scale, labels[1::2])
-        grad_1 = torch.autograd.grad(loss_1, [self.scale], create_graph=True)[0]
-        grad_2 = torch.autograd.grad(loss_2, [self.scale], create_graph=True)[0]
-        penalty = torch.sum(grad_1 * grad_2)
+    def forward(self, y: torch.Tensor, labels: torch.Tensor, domain_idx: torch.Tensor = None,
+                num_domains: int = 1) -> torch.Tensor:
+        expected = (F.softmax(y, dim=1) * y).sum(dim=1)
+        scale_grad = expected - y.gather(1, labels.unsqueeze(1)).squeeze(1)
+        if domain_idx is None:
+            domain_idx = torch.zeros_like(labels)
+        # Samples at even and odd positions form the two halves
+        half = torch.arange(len(labels), device=labels.device) % 2
+        grad = utils.segment_mean(scale_grad, domain_idx * 2 + half, num_domains * 2).view(num_domains, 2)
+        penalty = (grad[:, 0] * grad[:, 1]).mean()
         
         return penalty
 
@@ -36,7 +43,8 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                      dropout=args.dropout).to(self.device)
+                                      dropout=args.dropout, rank=args.head_rank,
+                                      **self._get_backbone_kwargs()).to(self.device)
         self.irm = InvariancePenaltyLoss()
         self._init_data()
     
@@ -48,7 +56,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -59,7 +67,7 @@ class Trainset(InitTrain):
         elif args.train_mode == 'source_combine':
             src = args.source_name
         elif args.train_mode == 'multi_source':
-            raise Exception("This model cannot be trained in multi_source mode.")
+            src = args.source_name
 
         self.optimizer = self._get_optimizer(self.model)
         self.lr_scheduler = self._get_lr_scheduler(self.optimizer)
@@ -84,14 +92,25 @@ class Trainset(InitTrain):
             
             num_iter = len(self.dataloaders['train'])              
             for i in tqdm(range(num_iter), ascii=True):
-                source_data, source_labels = utils.get_next_batch(self.dataloaders,
-            						     self.iters, src, self.device)
+                if args.train_mode == 'multi_source':
+                    # Every source domain is an environment of the penalty
+                    source_data, source_labels, domain_idx = utils.get_multi_source_batch(self.dataloaders,
+                                                                         self.iters, src, self.device)
+                else:
+                    source_data, source_labels = utils.get_next_batch(self.dataloaders,
+                                                 self.iters, src, self.device)
+                    domain_idx = None
                 # forward
                 self.optimizer.zero_grad()
                 pred, _ = self.model(source_data)
                 
-                loss_c = F.cross_entropy(pred, source_labels)
-                loss_irm = self.irm(pred, source_labels)
+                if domain_idx is None:
+                    loss_c = F.cross_entropy(pred, source_labels)
+                else:
+                    loss_c = utils.per_domain_loss(pred, source_labels, domain_idx, self.num_source)[0].mean()
+                # A batch without domain indices is a single environment, whatever the number of source names
+                loss_irm = self.irm(pred, source_labels, domain_idx,
+                                    self.num_source if domain_idx is not None else 1)
                 loss = loss_c + tradeoff[0] * loss_irm
                 epoch_acc['Source Data']  += utils.get_accuracy(pred, source_labels)
                 
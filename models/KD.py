@@ -0,0 +1,157 @@
+'''
+Paper: Hinton, G., Vinyals, O. and Dean, J., 2015. Distilling the knowledge in a neural network.
+    arXiv preprint arXiv:1503.02531.
+Note: A compact single-branch student is distilled from any trained teacher in ./models (set by --teacher_name
+    and --teacher_path). The student learns from the soft labels of the teacher on labelled source data and
+    unlabelled target data, so that it keeps the adapted accuracy of the teacher at a fraction of the FLOPs.
+'''
+import copy
+import torch
+import logging
+from tqdm import tqdm
+import torch.nn as nn
+import torch.nn.functional as F
+from collections import defaultdict
+
+import utils
+import model_base
+import inference_utils
+from train_utils import InitTrain
+
+
+def distillation_loss(y_student, y_teacher, temperature):
+    p_teacher = F.softmax(y_teacher / temperature, dim=1)
+    log_p_student = F.log_softmax(y_student / temperature, dim=1)
+    return F.kl_div(log_p_student, p_teacher, reduction='batchmean') * temperature ** 2
+
+
+class Trainset(InitTrain):
+
+    def __init__(self, args):
+        super(Trainset, self).__init__(args)
+        output_size = 512
+        self.model = nn.Sequential(
+            model_base.FeatureExtractor(in_channel=1, window_sizes=[args.student_kernel], dropout=args.dropout,
+                                        **self._get_backbone_kwargs()),
+            model_base.ClassifierMLP(output_size, args.num_classes, args.dropout, last=None,
+                                     rank=args.head_rank)).to(self.device)
+        self._init_data()
+
+    def save_model(self):
+        torch.save({
+            'model': self.model.state_dict()
+            }, self.args.save_path + '.pth')
+        logging.info('Model saved to {}'.format(self.args.save_path + '.pth'))
+
+    def load_model(self):
+        logging.info('Loading model from {}'.format(self.args.load_path))
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
+        self.model.load_state_dict(ckpt['model'])
+
+    def _get_teacher(self):
+        '''
+        Build the teacher networks without datasets and load its trained weights.
+        '''
+        args = copy.copy(self.args)
+        args.model_name, args.load_path = args.teacher_name, args.teacher_path
+        teacher = inference_utils.get_inference_model(inference_utils.build_trainer(args, init_data=False))
+        for p in teacher.parameters():
+            p.requires_grad = False
+        return teacher
+
+    def train(self):
+        args = self.args
+
+        if args.train_mode == 'single_source':
+            src = args.source_name[0]
+        else:
+            src = args.source_name
+        if not args.teacher_path:
+            raise Exception("A trained teacher checkpoint is required (--teacher_path).")
+
+        self.teacher = self._get_teacher()
+        example = next(iter(self.dataloaders['val']))[0].to(self.device)
+        logging.info('Teacher {}: {} parameters, {} MACs per sample'.format(args.teacher_name,
+                     inference_utils.count_parameters(self.teacher), inference_utils.count_flops(self.teacher, example)))
+        logging.info('Student: {} parameters, {} MACs per sample'.format(
+                     inference_utils.count_parameters(self.model), inference_utils.count_flops(self.model, example)))
+
+        self.optimizer = self._get_optimizer(self.model)
+        self.lr_scheduler = self._get_lr_scheduler(self.optimizer)
+
+        best_acc = 0.0
+        best_epoch = 0
+
+        for epoch in range(1, args.max_epoch+1):
+            logging.info('-'*5 + 'Epoch {}/{}'.format(epoch, args.max_epoch) + '-'*5)
+
+            # Update the learning rate
+            if self.lr_scheduler is not None:
+                logging.info('current lr: {}'.format(self.lr_scheduler.get_last_lr()))
+
+            # Each epoch has a training and val phase
+            epoch_acc = defaultdict(float)
+
+            # Set model to train mode or evaluate mode
+            self.model.train()
+            epoch_loss = defaultdict(float)
+            tradeoff = self._get_tradeoff(args.tradeoff, epoch)
+
+            num_iter = len(self.dataloaders['train'])
+            for i in tqdm(range(num_iter), ascii=True):
+                target_data, target_labels = utils.get_next_batch(self.dataloaders,
+                						 self.iters, 'train', self.device)
+                source_data, source_labels = utils.get_next_batch(self.dataloaders,
+            						     self.iters, src, self.device)
+                # forward
+                self.optimizer.zero_grad()
+                data = torch.cat((source_data, target_data), dim=0)
+                with torch.no_grad():
+                    y_teacher = self.teacher(data)
+
+                y = self.model(data)
+                y_s, _ = y.chunk(2, dim=0)
+
+                loss_c = F.cross_entropy(y_s, source_labels)
+                loss_kd = distillation_loss(y, y_teacher, args.kd_temperature)
+                loss = loss_c + tradeoff[0] * loss_kd
+                epoch_acc['Source Data']  += utils.get_accuracy(y_s, source_labels)
+                epoch_acc['Agreement with Teacher']  += utils.get_accuracy(y, y_teacher.argmax(dim=1))
+
+                epoch_loss['Source Classifier'] += loss_c
+                epoch_loss['Distillation'] += loss_kd
+
+                # backward
+                loss.backward()
+                self.optimizer.step()
+
+            # Print the train and val information via each epoch
+            for key in epoch_loss.keys():
+                logging.info('Train-Loss {}: {:.4f}'.format(key, epoch_loss[key]/num_iter))
+            for key in epoch_acc.keys():
+                logging.info('Train-Acc {}: {:.4f}'.format(key, epoch_acc[key]/num_iter))
+
+            # log the best model according to the val accuracy
+            new_acc = self.test()
+            if new_acc >= best_acc:
+                best_acc = new_acc
+                best_epoch = epoch
+            logging.info("The best model epoch {}, val-acc {:.4f}".format(best_epoch, best_acc))
+
+            if self.lr_scheduler is not None:
+                self.lr_scheduler.step()
+
+    def test(self):
+        self.model.eval()
+        acc = 0.0
+        iters = iter(self.dataloaders['val'])
+        num_iter = len(iters)
+        with torch.no_grad():
+            for i in tqdm(range(num_iter), ascii=True):
+                target_data, target_labels, _ = next(iters)
+                target_data, target_labels = target_data.to(self.device), target_labels.to(self.device)
+                pred = self.model(target_data)
+                acc += utils.get_accuracy(pred, target_labels)
+        acc /= num_iter
+        logging.info('Val-Acc Target Data: {:.4f}'.format(acc))
+        return acc
@@ -25,10 +25,10 @@ class Trainset(InitTrain):
         super(Trainset, self).__init__(args)
         output_size = 2560
         self.C1 = model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                        dropout=args.dropout, last=None).to(self.device)
+                        dropout=args.dropout, last=None, rank=args.head_rank).to(self.device)
         self.C2 = model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                        dropout=args.dropout, last=None).to(self.device)
-        self.G = model_base.FeatureExtractor(in_channel=1).to(self.device)
+                        dropout=args.dropout, last=None, rank=args.head_rank).to(self.device)
+        self.G = model_base.FeatureExtractor(in_channel=1, **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -41,7 +41,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.G.load_state_dict(ckpt['G'])
         self.C1.load_state_dict(ckpt['C1'])
         self.C2.load_state_dict(ckpt['C2'])
@@ -55,6 +55,7 @@ class Trainset(InitTrain):
             src = args.source_name
         elif args.train_mode == 'multi_source':
             raise Exception("This model cannot be trained in multi_source mode.")
+        assert args.mcd_generator_steps >= 1, f"mcd_generator_steps should be at least 1, but got {args.mcd_generator_steps}"
 
         self.optimizer_G = self._get_optimizer(self.G)
         self.optimizer_C = self._get_optimizer([self.C1, self.C2])
@@ -107,10 +108,11 @@ class Trainset(InitTrain):
                 self.optimizer_G.step()
                 self.optimizer_C.step()
                 
-                self.optimizer_G.zero_grad()
                 self.optimizer_C.zero_grad()
-                 
-                f = self.G(data)
+                
+                # Step 2 updates only the classifiers, so the features are computed without a graph
+                with torch.no_grad():
+                    f = self.G(data)
                 y_1 = self.C1(f)
                 y_2 = self.C2(f)
                 y1_s, y1_t = y_1.chunk(2, dim=0)
@@ -123,7 +125,10 @@ class Trainset(InitTrain):
                 loss.backward()
                 self.optimizer_C.step()
 
-                for k in range(4):
+                # Step 3 updates only the feature extractor, so no gradients are computed for the classifiers
+                utils.freeze_net(self.C1)
+                utils.freeze_net(self.C2)
+                for k in range(args.mcd_generator_steps):
                     self.optimizer_G.zero_grad()
                     f = self.G(target_data)
                     y_1 = self.C1(f)
@@ -134,11 +139,13 @@ class Trainset(InitTrain):
                     epoch_loss['Step 3: Minimize discrepancy'] += loss_mcd
                     loss.backward()
                     self.optimizer_G.step()
+                utils.unfreeze_net(self.C1)
+                utils.unfreeze_net(self.C2)
                 
             # Print the train and val information via each epoch
             for key in epoch_loss.keys():
                 if key == 'Step 3: Minimize discrepancy':
-                    logging.info('Train-Loss {}: {:.4f}'.format(key, epoch_loss[key]/(4.*num_iter)))
+                    logging.info('Train-Loss {}: {:.4f}'.format(key, epoch_loss[key]/(args.mcd_generator_steps*num_iter)))
                 else:
                     logging.info('Train-Loss {}: {:.4f}'.format(key, epoch_loss[key]/num_iter))
             for key in epoch_acc.keys():
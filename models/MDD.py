@@ -70,11 +70,11 @@ class GeneralModule(nn.Module):
     def __init__(self, args, grl):
         super(GeneralModule, self).__init__()
         output_size = 2560
-        self.G = model_base.FeatureExtractor(in_channel=1)
+        self.G = model_base.FeatureExtractor(in_channel=1, **self._get_backbone_kwargs())
         self.C1 = model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                        dropout=args.dropout, last=None)
+                        dropout=args.dropout, last=None, rank=args.head_rank)
         self.C2 = model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                        dropout=args.dropout, last=None)
+                        dropout=args.dropout, last=None, rank=args.head_rank)
         self.grl_layer = utils.WarmStartGradientReverseLayer(alpha=1.0, lo=0.0, hi=0.1, max_iters=1000,
                                                        auto_step=False) if grl is None else grl
 
@@ -113,7 +113,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -22,11 +22,12 @@ class Trainset(InitTrain):
         super(Trainset, self).__init__(args)
         output_size = 2560
         self.mkmmd = utils.MultipleKernelMaximumMeanDiscrepancy(
-                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)])
-        self.G = model_base.FeatureExtractor(in_channel=1).to(self.device)
-        self.Cs = nn.ModuleList([model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                                                          dropout=args.dropout, last=None) \
-                                                          for _ in range(self.num_source)]).to(self.device)
+                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+                    **self._get_mkmmd_kwargs())
+        self.G = model_base.FeatureExtractor(in_channel=1, **self._get_backbone_kwargs()).to(self.device)
+        self.Cs = model_base.StackedClassifierMLP(num_heads=self.num_source, input_size=output_size,
+                                                  output_size=args.num_classes, dropout=args.dropout,
+                                                  last=None, rank=args.head_rank).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -38,7 +39,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.G.load_state_dict(ckpt['G'])
         self.Cs.load_state_dict(ckpt['Cs'])
         
@@ -84,18 +85,13 @@ class Trainset(InitTrain):
                 
                 f = self.G(data)
                 f_s, f_t = f.chunk(2, dim=0)
-                y_s = self.Cs[src_idx](f_s)
-                y_t = [cl(f_t) for cl in self.Cs]
+                # Only the head of the sampled source domain is evaluated on the source samples
+                y_s, y_t = self.Cs.forward_head(f_s, int(src_idx)), self.Cs(f_t)
                 
                 loss_c = F.cross_entropy(y_s, source_labels)
                 loss_mmd = self.mkmmd(f_s, f_t)
                 
-                logits_tgt = [F.softmax(t, dim=1) for t in y_t]
-                loss_l1 = 0.0
-                for k in range(self.num_source - 1):
-                    for j in range(k+1, self.num_source):
-                        loss_l1 += torch.abs(logits_tgt[k] - logits_tgt[j]).mean()
-                loss_l1 /= self.num_source
+                loss_l1 = utils.pairwise_discrepancy(F.softmax(y_t, dim=-1)) / self.num_source
            
                 loss = loss_c + tradeoff[0] * loss_mmd + tradeoff[1] * loss_l1
                 
@@ -137,12 +133,7 @@ class Trainset(InitTrain):
                 target_data, target_labels, _ = next(iters)
                 target_data, target_labels = target_data.to(self.device), target_labels.to(self.device)
                 feat_tgt = self.G(target_data)
-                logits_tgt = [cl(feat_tgt) for cl in self.Cs]
-                logits_tgt = [F.softmax(data, dim=1) for data in logits_tgt]
-                
-                pred = torch.zeros((logits_tgt[0].shape)).to(self.device)
-                for j in range(self.num_source):
-                    pred += logits_tgt[j]
+                pred = F.softmax(self.Cs(feat_tgt), dim=-1).sum(dim=0)
                 acc += utils.get_accuracy(pred, target_labels)
         acc /= num_iter
         logging.info('Val-Acc Target Data: {:.4f}'.format(acc))
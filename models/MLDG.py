@@ -4,12 +4,11 @@ Paper: Li, D., Yang, Y., Song, Y.Z. and Hospedales, T., 2018, April. Learning to
 Reference code: https://github.com/thuml/Transfer-Learning-Library
 '''
 import torch
-import higher
 import logging
-import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.func import functional_call
 from collections import defaultdict
 
 import utils
@@ -22,9 +21,11 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         self.mkmmd = utils.MultipleKernelMaximumMeanDiscrepancy(
-                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)])
+                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+                    **self._get_mkmmd_kwargs())
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                      dropout=args.dropout).to(self.device)
+                                      dropout=args.dropout, rank=args.head_rank,
+                                      **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -35,21 +36,49 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
+    def _inner_step(self, loss, second_order=True):
+        '''
+        Parameters after one step of the SGD optimizer on the meta-train loss, with its current learning rate,
+        weight decay and momentum buffers (as the differentiable copy of the optimizer in the original code).
+        With second_order, the meta-test gradient flows through the step. Otherwise the step is a constant
+        (first-order MLDG), and the meta-train gradients are accumulated in .grad here, so that the meta-train
+        graph is not traversed again.
+        '''
+        params = dict(self.model.named_parameters())
+        grads = torch.autograd.grad(loss, list(params.values()), create_graph=second_order, allow_unused=True)
+        group = self.optimizer.param_groups[0]
+        fast_params = {}
+        for (name, p), g in zip(params.items(), grads):
+            if g is None:
+                fast_params[name] = p
+                continue
+            if not second_order:
+                p.grad = g if p.grad is None else p.grad + g
+            d_p = g + group['weight_decay'] * p if group['weight_decay'] != 0 else g
+            buf = self.optimizer.state[p].get('momentum_buffer') if group['momentum'] != 0 else None
+            if buf is not None:
+                d_p = group['momentum'] * buf + d_p
+            fast_params[name] = p - group['lr'] * d_p
+        return fast_params
+        
     def train(self):
         args = self.args
         src = args.source_name
         
         if args.train_mode != 'multi_source':
             raise Exception("For this model, invalid train mode: {}".format(args.train_mode))
+        if args.opt != 'sgd':
+            raise Exception("The inner step of this model is an SGD step, so it only supports --opt sgd.")
 
         self.optimizer = self._get_optimizer(self.model)
         self.lr_scheduler = self._get_lr_scheduler(self.optimizer)
         
         best_acc = 0.0
         best_epoch = 0
+        second_order = args.mldg_order == 'second'
    
         for epoch in range(1, args.max_epoch+1):
             logging.info('-'*5 + 'Epoch {}/{}'.format(epoch, args.max_epoch) + '-'*5)
@@ -68,43 +97,30 @@ class Trainset(InitTrain):
             
             num_iter = len(self.dataloaders['train'])              
             for i in tqdm(range(num_iter), ascii=True):
-                source_data, source_labels = [], []
-                for idx in range(self.num_source):
-                    source_data_item, source_labels_item = utils.get_next_batch(self.dataloaders,
-                                                self.iters, src[idx], self.device)
-                    source_data.append(source_data_item)
-                    source_labels.append(source_labels_item)
-                idx_range = torch.arange(0, self.num_source)
-                train_idx = np.random.choice(idx_range, size=(self.num_source - 1,), replace=False)
-                test_idx = np.setdiff1d(idx_range, train_idx)
+                source_data, source_labels, domain_idx = utils.get_multi_source_batch(self.dataloaders,
+                                                                     self.iters, src, self.device)
+                train_idx = torch.randperm(self.num_source, device=self.device)[:self.num_source - 1]
+                is_train = torch.isin(domain_idx, train_idx)
                 
                 self.optimizer.zero_grad()
-                with higher.innerloop_ctx(self.model, self.optimizer, copy_initial_weights=False) as (inner_model, inner_optimizer):
-                    for _ in range(1):  # Single gradient update (for simplicity)
-                        loss_inner = 0
-                        for idx in train_idx:
-                            y, _ = inner_model(source_data[idx])
-                            loss_inner += F.cross_entropy(y, source_labels[idx]) / len(train_idx)
-                        inner_optimizer.step(loss_inner)
-
-                    loss_outer = 0
-                    cls_acc = 0
-
-                    for idx in train_idx:
-                        y, _ = self.model(source_data[idx])
-                        loss_outer += F.cross_entropy(y, source_labels[idx]) / len(train_idx)
+                # Meta-train: one forward over the meta-train domains, whose loss is also the first outer term
+                y, _ = self.model(source_data[is_train])
+                loss_inner = utils.per_domain_loss(y, source_labels[is_train], domain_idx[is_train],
+                                                   self.num_source)[0][train_idx].mean()
+                fast_params = self._inner_step(loss_inner, second_order)
 
-                    for idx in test_idx:
-                        y, _ = inner_model(source_data[idx])
-                        loss_outer += F.cross_entropy(y, source_labels[idx]) * tradeoff[0] / len(test_idx)
-                        cls_acc += utils.get_accuracy(y, source_labels[idx]) / len(test_idx)
+                # Meta-test: one forward over the meta-test domains with the updated parameters
+                y, _ = functional_call(self.model, fast_params, (source_data[~is_train],))
+                loss_test = F.cross_entropy(y, source_labels[~is_train])
+                loss_outer = loss_inner + tradeoff[0] * loss_test
+                cls_acc = utils.get_accuracy(y, source_labels[~is_train])
                 epoch_acc['Source Data']  += cls_acc
                 
                 epoch_loss['Meta-train'] += loss_inner
                 epoch_loss['Meta_test'] += loss_outer
 
-                # backward
-                loss_outer.backward()
+                # backward (in first-order mode, the gradients of loss_inner are already accumulated)
+                (loss_outer if second_order else tradeoff[0] * loss_test).backward()
                 self.optimizer.step()
                             
             # Print the train and val information via each epoch
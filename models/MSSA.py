@@ -30,7 +30,7 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         output_size = 2560
-        self.G_shared = model_base.FeatureExtractor(in_channel=1).to(self.device)
+        self.G_shared = model_base.FeatureExtractor(in_channel=1, **self._get_backbone_kwargs()).to(self.device)
         '''
         # Specific feature extractors defined in the paper will not be used.
         self.Gs_specific = nn.ModuleList([nn.Sequential(
@@ -39,11 +39,12 @@ class Trainset(InitTrain):
                                                     nn.ReLU()) \
                                                     for _ in range(self.num_source)]).to(self.device)
         '''
-        self.Cs = nn.ModuleList([model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                                                          dropout=args.dropout, last=None) \
-                                                          for _ in range(self.num_source)]).to(self.device)
+        self.Cs = model_base.StackedClassifierMLP(num_heads=self.num_source, input_size=output_size,
+                                                  output_size=args.num_classes, dropout=args.dropout,
+                                                  last=None, rank=args.head_rank).to(self.device)
         self.mkmmd = utils.MultipleKernelMaximumMeanDiscrepancy(
-                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)])
+                    kernels=[utils.GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+                    **self._get_mkmmd_kwargs())
     
     def save_model(self):
         torch.save({
@@ -55,7 +56,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.G_shared.load_state_dict(ckpt['G_shared'])
         # self.Gs_specific.load_state_dict(ckpt['Gs_specific'])
         self.Cs.load_state_dict(ckpt['Cs'])
@@ -128,10 +129,10 @@ class Trainset(InitTrain):
                 y_s = [self.Cs[j](f_specific[j]) for j in range(self.num_source)]
                 '''
                 
-                y_s = [self.Cs[j](f[j]) for j in range(self.num_source)]
-                loss_cls = 0.0
-                for j in range(self.num_source):
-                    loss_cls += F.cross_entropy(y_s[j], source_labels[j])
+                # Every head only classifies the features of its own source
+                y_s = self.Cs(torch.stack(f[:self.num_source], dim=0))
+                loss_cls = F.cross_entropy(y_s.transpose(1, 2), torch.stack(source_labels, dim=0),
+                                           reduction='none').mean(dim=1).sum()
                 loss_sum_mmd = 0.0
                 for k in range(self.num_source):
                     loss_sum_mmd += self.mkmmd(f[k], f[-1])
@@ -196,12 +197,7 @@ class Trainset(InitTrain):
                 feat_tgt = [self.Gs_specific[j](feat_tgt) for j in range(self.num_source)]
                 logits_tgt = [self.Cs[j](feat_tgt[j]) for j in range(self.num_source)]
                 '''
-                logits_tgt = [self.Cs[j](feat_tgt) for j in range(self.num_source)]
-                logits_tgt = [F.softmax(data, dim=1) for data in logits_tgt]
-                
-                pred = torch.zeros((logits_tgt[0].shape)).to(self.device)
-                for j in range(self.num_source):
-                    pred += logits_tgt[j]
+                pred = F.softmax(self.Cs(feat_tgt), dim=-1).sum(dim=0)
                 acc += utils.get_accuracy(pred, target_labels)
         acc /= num_iter
         logging.info('Val-Acc Target Data: {:.4f}'.format(acc))
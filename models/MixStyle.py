@@ -3,7 +3,6 @@ Paper: Zhou, K., Yang, Y., Qiao, Y. and Xiang, T., 2021. Domain generalization w
     mixstyle. arXiv preprint arXiv:2104.02008.
 Reference code: https://github.com/thuml/Transfer-Learning-Library
 '''
-import random
 import torch
 import logging
 from tqdm import tqdm
@@ -29,32 +28,29 @@ class MixStyle(nn.Module):
         if not self.training:
             return x
 
-        if random.random() > self.p:
+        # torch random numbers, which are restored when the layer is recomputed by activation checkpointing
+        if torch.rand(1).item() > self.p:
             return x
 
         batch_size = x.size(0)
 
-        mu = x.mean(dim=-1, keepdim=True)
-        var = x.var(dim=-1, keepdim=True)
+        var, mu = torch.var_mean(x, dim=-1, keepdim=True)
         sigma = (var + self.eps).sqrt()
         mu, sigma = mu.detach(), sigma.detach()
-        x_normed = (x - mu) / sigma
 
         interpolation = self.beta.sample((batch_size, 1, 1))
         interpolation = interpolation.to(x.device)
 
-        # split into two halves and swap the order
-        perm = torch.arange(batch_size - 1, -1, -1)  # inverse index
-        perm_b, perm_a = perm.chunk(2)
-        perm_b = perm_b[torch.randperm(batch_size // 2)]
-        perm_a = perm_a[torch.randperm(batch_size // 2)]
-        perm = torch.cat([perm_b, perm_a], 0)
+        # the first half is mixed with a random order of the second half and vice versa
+        perm = torch.cat([torch.randperm(batch_size - batch_size // 2, device=x.device) + batch_size // 2,
+                          torch.randperm(batch_size // 2, device=x.device)], 0)
 
-        mu_perm, sigma_perm = mu[perm], sigma[perm]
-        mu_mix = mu * interpolation + mu_perm * (1 - interpolation)
-        sigma_mix = sigma * interpolation + sigma_perm * (1 - interpolation)
+        mu_mix = torch.lerp(mu[perm], mu, interpolation)
+        sigma_mix = torch.lerp(sigma[perm], sigma, interpolation)
 
-        return x_normed * sigma_mix + mu_mix
+        # (x - mu) / sigma * sigma_mix + mu_mix as a single operation over x
+        scale = sigma_mix / sigma
+        return torch.addcmul(mu_mix - mu * scale, x, scale)
 
 
 class MixStyleLayer(nn.Module):
@@ -119,9 +115,10 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         output_size = 2560
-        self.G = model_base.FeatureExtractor(in_channel=1, block=MixStyleLayer, dropout=args.dropout).to(self.device)
+        self.G = model_base.FeatureExtractor(in_channel=1, block=MixStyleLayer, dropout=args.dropout,
+                                             **self._get_backbone_kwargs()).to(self.device)
         self.C = model_base.ClassifierMLP(input_size=output_size, output_size=args.num_classes,
-                                          dropout=args.dropout, last=None).to(self.device)
+                                          dropout=args.dropout, last=None, rank=args.head_rank).to(self.device)
         self._init_data(concat_src=True)
     
     def save_model(self):
@@ -133,7 +130,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.G.load_state_dict(ckpt['G'])
         self.C.load_state_dict(ckpt['C'])
     
@@ -1,7 +1,6 @@
 import torch
 import logging
 from tqdm import tqdm
-import torch.nn.functional as F
 from collections import defaultdict
 
 import utils
@@ -14,7 +13,8 @@ class Trainset(InitTrain):
     def __init__(self, args):
         super(Trainset, self).__init__(args)
         self.model = model_base.BaseModel(input_size=1, num_classes=args.num_classes,
-                                       dropout=args.dropout).to(self.device)
+                                       dropout=args.dropout, rank=args.head_rank,
+                                       **self._get_backbone_kwargs()).to(self.device)
         self._init_data()
     
     def save_model(self):
@@ -25,7 +25,7 @@ class Trainset(InitTrain):
     
     def load_model(self):
         logging.info('Loading model from {}'.format(self.args.load_path))
-        ckpt = torch.load(self.args.load_path)
+        ckpt = torch.load(self.args.load_path, map_location=self.device)
         self.model.load_state_dict(ckpt['model'])
         
     def train(self):
@@ -58,23 +58,13 @@ class Trainset(InitTrain):
         
             num_iter = len(self.dataloaders['train'])              
             for i in tqdm(range(num_iter), ascii=True):
-                source_data, labels_per_domain = [], []
-                for idx in range(self.num_source):
-                    source_data_item, source_labels_item = utils.get_next_batch(self.dataloaders,
-                                                self.iters, src[idx], self.device)
-                    source_data.append(source_data_item)
-                    labels_per_domain.append(source_labels_item)
-                source_data = torch.cat(source_data, dim=0)
-                source_labels = torch.cat(labels_per_domain, dim=0)
+                source_data, source_labels, domain_idx = utils.get_multi_source_batch(self.dataloaders,
+                                                                     self.iters, src, self.device)
                 
                 # forward
                 self.optimizer.zero_grad()
                 pred_all, _ = self.model(source_data)
-                pred_per_domain = pred_all.chunk(self.num_source, dim=0)
-
-                loss_ce_per_domain = torch.zeros(self.num_source).to(self.device)
-                for idx in range(self.num_source):
-                    loss_ce_per_domain[idx] = F.cross_entropy(pred_per_domain[idx], labels_per_domain[idx])
+                loss_ce_per_domain, _ = utils.per_domain_loss(pred_all, source_labels, domain_idx, self.num_source)
 
                 # cls loss
                 loss_ce = loss_ce_per_domain.mean()
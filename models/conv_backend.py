@@ -0,0 +1,143 @@
+'''
+Selectable implementations of nn.Conv1d for long windows and large kernels.
+'direct' is the built-in convolution, 'im2col' unfolds the input into columns and uses one matrix
+multiplication, and 'fft' multiplies the spectra of the input and the kernel. With 'auto', every backend is
+timed once for each layer shape on the host (at the first forward pass of that shape), and the fastest one is
+cached and used for the rest of the run. Only the forward computation changes, so the parameters and
+checkpoints are the same as nn.Conv1d.
+'''
+import time
+import torch
+import logging
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+BACKENDS = ['direct', 'im2col', 'fft']
+
+# The fastest backend of every layer shape, filled by SelectableConv1d with backend 'auto'
+_best_backend = {}
+
+
+def conv1d_im2col(input, weight, bias):
+    '''
+    Convolution (stride 1, no padding) as unfolded columns times the flattened kernels.
+    '''
+    out_channels, in_channels, kernel_size = weight.shape
+    cols = input.unfold(-1, kernel_size, 1)
+    cols = cols.permute(0, 2, 1, 3).reshape(input.shape[0], cols.shape[2], in_channels * kernel_size)
+    out = torch.matmul(cols, weight.reshape(out_channels, -1).t())
+    if bias is not None:
+        out = out + bias
+    return out.transpose(1, 2)
+
+
+def fft_length(length):
+    '''
+    Smallest length of at least length with only the factors 2, 3 and 5, for which the FFT is fast.
+    '''
+    n = length
+    while True:
+        m = n
+        for p in [2, 3, 5]:
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def conv1d_fft(input, weight, bias):
+    '''
+    Convolution (stride 1, no padding) by the product of the spectra of the input and the flipped kernels.
+    The circular convolution does not wrap into the valid outputs, so no extra padding is needed.
+    '''
+    length, kernel_size = input.shape[-1], weight.shape[-1]
+    n = fft_length(length)
+    spec = torch.fft.rfft(input, n=n)
+    spec_w = torch.fft.rfft(weight.flip(-1), n=n)
+    # Sum over the input channels for every frequency
+    out = torch.einsum('bcf,ocf->bof', spec, spec_w)
+    out = torch.fft.irfft(out, n=n)[..., kernel_size-1:length]
+    if bias is not None:
+        out = out + bias.unsqueeze(-1)
+    return out
+
+
+class SelectableConv1d(nn.Conv1d):
+    '''
+    nn.Conv1d with a selectable backend ('direct', 'im2col', 'fft' or 'auto').
+    Strided, dilated, grouped and non-zero padded convolutions always use 'direct'.
+    '''
+    def __init__(self, *args, backend='auto', **kwargs):
+        super(SelectableConv1d, self).__init__(*args, **kwargs)
+        self.backend = backend
+
+    def _supported(self):
+        return self.stride[0] == 1 and self.dilation[0] == 1 and self.groups == 1 and \
+               self.padding_mode == 'zeros' and not isinstance(self.padding, str)
+
+    def _forward(self, input, backend):
+        if backend == 'direct':
+            return super(SelectableConv1d, self).forward(input)
+        input = F.pad(input, (self.padding[0], self.padding[0]))
+        if backend == 'im2col':
+            return conv1d_im2col(input, self.weight, self.bias)
+        return conv1d_fft(input, self.weight, self.bias)
+
+    def _select(self, input):
+        key = (tuple(input.shape), self.out_channels, self.kernel_size[0], self.padding[0],
+               input.device.type, input.dtype, torch.is_grad_enabled())
+        if key not in _best_backend:
+            _best_backend[key] = benchmark(self, input)
+            logging.info('Conv1d backend for input {}, {} channels, kernel {}: {}'.format(
+                         tuple(input.shape), self.out_channels, self.kernel_size[0], _best_backend[key]))
+        return _best_backend[key]
+
+    def forward(self, input):
+        if not self._supported():
+            return super(SelectableConv1d, self).forward(input)
+        backend = self._select(input) if self.backend == 'auto' else self.backend
+        return self._forward(input, backend)
+
+
+def benchmark(conv, input, repeats=5):
+    '''
+    Fastest backend of conv for input. The backward pass is included if gradients are enabled.
+    '''
+    times = {}
+    input = input.detach().requires_grad_(torch.is_grad_enabled() and input.requires_grad)
+    for backend in BACKENDS:
+        elapsed = []
+        for i in range(repeats + 1):
+            start = time.perf_counter()
+            out = conv._forward(input, backend)
+            if out.requires_grad:
+                torch.autograd.grad(out.sum(), [p for p in conv.parameters() if p.requires_grad])
+            if input.is_cuda:
+                torch.cuda.synchronize()
+            # The first run is a warm-up
+            if i > 0:
+                elapsed.append(time.perf_counter() - start)
+        times[backend] = sorted(elapsed)[len(elapsed) // 2]
+    return min(times, key=times.get)
+
+
+def set_backend(module, backend):
+    '''
+    Replace every nn.Conv1d in module by a SelectableConv1d with the given backend, or back to
+    nn.Conv1d if backend is 'direct'. The parameters are shared with the replaced layers.
+    '''
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv1d):
+            cls = nn.Conv1d if backend == 'direct' else SelectableConv1d
+            kwargs = {} if backend == 'direct' else {'backend': backend}
+            conv = cls(child.in_channels, child.out_channels, child.kernel_size, stride=child.stride,
+                       padding=child.padding, dilation=child.dilation, groups=child.groups,
+                       bias=child.bias is not None, padding_mode=child.padding_mode,
+                       device='meta', **kwargs)
+            conv.weight, conv.bias = child.weight, child.bias
+            setattr(module, name, conv)
+        else:
+            set_backend(child, backend)
+    return module
@@ -1,5 +1,7 @@
+import math
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 
 
 class ClassifierMLP(nn.Module):
@@ -8,20 +10,22 @@ class ClassifierMLP(nn.Module):
                  input_size,
                  output_size,
                  dropout,
-                 last='tanh'):
+                 last='tanh',
+                 rank=0):
         super(ClassifierMLP, self).__init__()
         
+        # rank: Rank of the factorized Linear layers (0 means dense), see get_linear
         self.last = last
         self.net = nn.Sequential(
                    nn.Dropout(p=dropout),
                    
-                   nn.Linear(input_size, int(input_size/4)),
+                   get_linear(input_size, int(input_size/4), rank),
                    nn.ReLU(),
                    
-                   nn.Linear(int(input_size/4), int(input_size/16)),
+                   get_linear(int(input_size/4), int(input_size/16), rank),
                    nn.ReLU(),
                    
-                   nn.Linear(int(input_size/16), output_size))
+                   get_linear(int(input_size/16), output_size, rank))
         
         if last == 'logsm':
             self.last_layer = nn.LogSoftmax(dim=-1)
@@ -42,40 +46,213 @@ class ClassifierMLP(nn.Module):
         return y
 
 
+class StackedLinear(nn.Module):
+    '''
+    Independent Linear layers of several heads, stored as batched tensors and evaluated with one batched matmul.
+    The input is (batch, in_features) shared by all heads or (num_heads, batch, in_features).
+    '''
+    def __init__(self, num_heads, in_features, out_features, bias=True):
+        super(StackedLinear, self).__init__()
+        self.num_heads = num_heads
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(num_heads, in_features, out_features))
+        # Same initialization as nn.Linear
+        bound = 1. / math.sqrt(in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        if bias:
+            self.bias = nn.Parameter(torch.empty(num_heads, out_features))
+            nn.init.uniform_(self.bias, -bound, bound)
+        else:
+            self.register_parameter('bias', None)
+
+    def forward(self, input):
+        if self.bias is None:
+            return torch.matmul(input, self.weight)
+        if input.dim() == 2:
+            return torch.matmul(input, self.weight) + self.bias.unsqueeze(1)
+        return torch.baddbmm(self.bias.unsqueeze(1), input, self.weight)
+
+    def forward_head(self, input, idx):
+        '''
+        Output of head idx alone for an input (batch, in_features).
+        '''
+        if self.bias is None:
+            return torch.mm(input, self.weight[idx])
+        return torch.addmm(self.bias[idx], input, self.weight[idx])
+
+
+class LowRankLinear(nn.Module):
+    '''
+    Linear layer factorized into a projection U to rank features without bias and a Linear layer V.
+    num_heads: Number of stacked heads (StackedLinear), or None for a single nn.Linear.
+    '''
+    def __init__(self, in_features, out_features, rank, num_heads=None):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        if num_heads is None:
+            self.U = nn.Linear(in_features, rank, bias=False)
+            self.V = nn.Linear(rank, out_features)
+        else:
+            self.U = StackedLinear(num_heads, in_features, rank, bias=False)
+            self.V = StackedLinear(num_heads, rank, out_features)
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        '''
+        Truncated SVD of the weights of a trained nn.Linear or StackedLinear.
+        '''
+        stacked = isinstance(linear, StackedLinear)
+        layer = cls(linear.in_features, linear.out_features, rank,
+                    num_heads=linear.num_heads if stacked else None).to(linear.weight.device)
+        with torch.no_grad():
+            u, s, vh = torch.linalg.svd(linear.weight, full_matrices=False)
+            s = s[..., :rank].sqrt()
+            u, vh = u[..., :rank] * s.unsqueeze(-2), vh[..., :rank, :] * s.unsqueeze(-1)
+            # nn.Linear stores (out, in) and StackedLinear stores (heads, in, out)
+            layer.U.weight.copy_(u if stacked else vh)
+            layer.V.weight.copy_(vh if stacked else u)
+            layer.V.bias.copy_(linear.bias)
+        return layer
+
+    def forward(self, input):
+        return self.V(self.U(input))
+
+    def forward_head(self, input, idx):
+        return self.V.forward_head(self.U.forward_head(input, idx), idx)
+
+
+def use_low_rank(in_features, out_features, rank):
+    '''
+    Whether rank is positive and a rank-r factorization has fewer parameters than the dense layer.
+    '''
+    return rank > 0 and rank * (in_features + out_features) < in_features * out_features
+
+
+def get_linear(in_features, out_features, rank=0, num_heads=None):
+    '''
+    A LowRankLinear if use_low_rank holds, otherwise a dense nn.Linear (StackedLinear if num_heads is set).
+    '''
+    if use_low_rank(in_features, out_features, rank):
+        return LowRankLinear(in_features, out_features, rank, num_heads)
+    if num_heads is None:
+        return nn.Linear(in_features, out_features)
+    return StackedLinear(num_heads, in_features, out_features)
+
+
+class StackedClassifierMLP(nn.Module):
+    '''
+    num_heads ClassifierMLPs with the weights of each layer stacked. The output is (num_heads, batch, output_size).
+    Checkpoints of an nn.ModuleList of ClassifierMLPs can be loaded directly.
+    '''
+    def __init__(self,
+                 num_heads,
+                 input_size,
+                 output_size,
+                 dropout,
+                 last='tanh',
+                 rank=0):
+        super(StackedClassifierMLP, self).__init__()
+
+        self.num_heads = num_heads
+        self.last = last
+        self.net = nn.Sequential(
+                   nn.Dropout(p=dropout),
+
+                   get_linear(input_size, int(input_size/4), rank, num_heads),
+                   nn.ReLU(),
+
+                   get_linear(int(input_size/4), int(input_size/16), rank, num_heads),
+                   nn.ReLU(),
+
+                   get_linear(int(input_size/16), output_size, rank, num_heads))
+
+        if last == 'logsm':
+            self.last_layer = nn.LogSoftmax(dim=-1)
+        elif last == 'sm':
+            self.last_layer = nn.Softmax(dim=-1)
+        elif last == 'tanh':
+            self.last_layer = nn.Tanh()
+        elif last == 'sigmoid':
+            self.last_layer = nn.Sigmoid()
+        elif last == 'relu':
+            self.last_layer = nn.ReLU()
+
+    def __len__(self):
+        return self.num_heads
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Convert the weights of an nn.ModuleList of ClassifierMLPs (e.g. '0.net.1.weight' of shape (out, in))
+        for idx, layer in enumerate(self.net):
+            if not isinstance(layer, StackedLinear):
+                continue
+            for name in ['weight', 'bias']:
+                keys = [prefix + '{}.net.{}.{}'.format(h, idx, name) for h in range(self.num_heads)]
+                if all([key in state_dict for key in keys]):
+                    params = [state_dict.pop(key) for key in keys]
+                    state_dict[prefix + 'net.{}.{}'.format(idx, name)] = torch.stack(
+                        [p.t() if name == 'weight' else p for p in params], dim=0)
+        super(StackedClassifierMLP, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward_head(self, input, idx):
+        '''
+        Output (batch, output_size) of head idx alone, without evaluating the other heads.
+        '''
+        y = input
+        for layer in self.net:
+            y = layer.forward_head(y, idx) if isinstance(layer, (StackedLinear, LowRankLinear)) else layer(y)
+        if self.last != None:
+            y = self.last_layer(y)
+
+        return y
+
+    def forward(self, input):
+        # Dropout masks are drawn independently for every head
+        if self.training and self.net[0].p > 0 and input.dim() == 2:
+            input = input.expand(self.num_heads, *input.shape)
+        y = self.net(input)
+        if self.last != None:
+            y = self.last_layer(y)
+
+        return y
+
+
 class CNNlayer(nn.Module):
 
     def __init__(self,
                  in_channel=1, kernel_size=8, stride=1, padding=1,
-                 mp_kernel_size=2, mp_stride=2, dropout=0.):
+                 mp_kernel_size=2, mp_stride=2, dropout=0., channels=[4, 16, 32, 64, 128]):
         super(CNNlayer, self).__init__()
 
         layer1 = nn.Sequential(
-            nn.Conv1d(in_channel, 4, kernel_size=kernel_size, stride=stride, padding=padding),
-            nn.BatchNorm1d(4),
+            nn.Conv1d(in_channel, channels[0], kernel_size=kernel_size, stride=stride, padding=padding),
+            nn.BatchNorm1d(channels[0]),
             nn.ReLU(inplace=True),
             nn.MaxPool1d(kernel_size=mp_kernel_size, stride=mp_stride))
 
         layer2 = nn.Sequential(
-            nn.Conv1d(4, 16, kernel_size=kernel_size, stride=stride, padding=padding),
-            nn.BatchNorm1d(16),
+            nn.Conv1d(channels[0], channels[1], kernel_size=kernel_size, stride=stride, padding=padding),
+            nn.BatchNorm1d(channels[1]),
             nn.ReLU(inplace=True),
             nn.MaxPool1d(kernel_size=mp_kernel_size, stride=mp_stride))
 
         layer3 = nn.Sequential(
-            nn.Conv1d(16, 32, kernel_size=kernel_size, stride=stride, padding=padding),
-            nn.BatchNorm1d(32),
+            nn.Conv1d(channels[1], channels[2], kernel_size=kernel_size, stride=stride, padding=padding),
+            nn.BatchNorm1d(channels[2]),
             nn.ReLU(inplace=True),
             nn.MaxPool1d(kernel_size=mp_kernel_size, stride=mp_stride))
 
         layer4 = nn.Sequential(
-            nn.Conv1d(32, 64, kernel_size=kernel_size, stride=stride, padding=padding),
-            nn.BatchNorm1d(64),
+            nn.Conv1d(channels[2], channels[3], kernel_size=kernel_size, stride=stride, padding=padding),
+            nn.BatchNorm1d(channels[3]),
             nn.ReLU(inplace=True),
             nn.MaxPool1d(kernel_size=mp_kernel_size, stride=mp_stride))
 
         layer5 = nn.Sequential(
-            nn.Conv1d(64, 128, kernel_size=kernel_size, stride=stride, padding=padding),
-            nn.BatchNorm1d(128),
+            nn.Conv1d(channels[3], channels[4], kernel_size=kernel_size, stride=stride, padding=padding),
+            nn.BatchNorm1d(channels[4]),
             nn.ReLU(inplace=True),
             nn.AdaptiveMaxPool1d(4),
             nn.Flatten())
@@ -96,19 +273,138 @@ class CNNlayer(nn.Module):
         return h
 
 
+class SharedStem(nn.Module):
+    '''
+    First conv layer of all branches evaluated over the input once. The convolutions of every kernel size are
+    followed by a shared BatchNorm, ReLU and a pooling of stride pool, so the branches run at 1/pool of the length.
+    The output has out_channels channels for each kernel size, in the order of window_sizes.
+    '''
+    def __init__(self, in_channel, window_sizes, out_channels=4, pool=4, norms=None):
+        super(SharedStem, self).__init__()
+        self.out_channels = out_channels
+        # Padding of half the kernel keeps the length of the input for every kernel size
+        self.convs = nn.ModuleList([nn.Conv1d(in_channel, out_channels, kernel_size=h, padding=h//2)
+                                    for h in window_sizes])
+        # norms: Normalization layer of every kernel size (e.g. the IBN layers of the branches), instead of
+        # the shared BatchNorm
+        self.bn = nn.BatchNorm1d(out_channels * len(window_sizes)) if norms is None else None
+        self.norms = None if norms is None else nn.ModuleList(norms)
+        self.relu = nn.ReLU(inplace=True)
+        self.pool = nn.MaxPool1d(kernel_size=pool, stride=pool)
+
+    def forward(self, input):
+        length = input.shape[-1]
+        out = [conv(input)[..., :length] for conv in self.convs]
+        if self.norms is None:
+            out = self.bn(torch.cat(out, dim=1))
+        else:
+            out = torch.cat([norm(o) for norm, o in zip(self.norms, out)], dim=1)
+        return self.pool(self.relu(out))
+
+
+def checkpoint_forward(module, input):
+    '''
+    module(input) with activation checkpointing: the intermediate activations of module are recomputed in the
+    backward pass instead of stored. The random state is restored for the recomputation, and the running
+    statistics of the BatchNorm layers are only updated by the first forward pass.
+    '''
+    calls = []
+    def run(x):
+        calls.append(1)
+        if len(calls) == 1:
+            return module(x)
+        bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        momentum = [bn.momentum for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.
+        try:
+            return module(x)
+        finally:
+            for bn, m in zip(bns, momentum):
+                bn.momentum = m
+    return torch.utils.checkpoint.checkpoint(run, input, use_reentrant=False)
+
+
 class FeatureExtractor(nn.Module):
     
-    def __init__(self, in_channel, window_sizes=[4, 8, 16, 24, 32], block=CNNlayer, dropout=0.):
+    def __init__(self, in_channel, window_sizes=[4, 8, 16, 24, 32], block=CNNlayer, dropout=0., channels=None,
+                 shared_stem=False, checkpoint='none', signal_size=None):
         super(FeatureExtractor, self).__init__()
-       
+        
+        # channels: Output channels of each conv layer in a branch (the default of the block if None)
+        block_kwargs = {} if channels is None else {'channels': channels}
+        self.window_sizes = list(window_sizes)
         self.convs = nn.ModuleList([
-                       block(in_channel=in_channel, kernel_size=h, dropout=dropout)
+                       block(in_channel=in_channel, kernel_size=h, dropout=dropout, **block_kwargs)
                        for h in window_sizes])
+        
+        # shared_stem: Replace the first layer of every branch by a SharedStem
+        self.stem = None
+        if shared_stem:
+            # The stem keeps the normalization of the first layer of the branches unless it is a BatchNorm
+            norms = [conv.fs[0][1] for conv in self.convs]
+            if all([type(norm) == nn.BatchNorm1d for norm in norms]):
+                norms = None
+            self.stem = SharedStem(in_channel, window_sizes, out_channels=self.convs[0].fs[0][0].out_channels,
+                                   norms=norms)
+            for conv in self.convs:
+                conv.fs[0] = nn.Identity()
+        
+        # checkpoint: Recompute the activations of every branch ('branch') or of every layer of the branches
+        # ('layer') in the backward pass instead of storing them, which trades compute for memory in training
+        assert checkpoint in ['none', 'branch', 'layer'], f"checkpoint should be 'none', 'branch' or 'layer', but got {checkpoint}"
+        self.checkpoint = checkpoint
                               
         self.fl = nn.Flatten()
+        
+        # signal_size: Length of the input, checked against the shortened branches of the shared stem
+        if shared_stem and signal_size is not None:
+            self._check_signal_size(in_channel, signal_size)
+
+    def _check_signal_size(self, in_channel, signal_size):
+        '''
+        The branches run at 1/4 of the length after the stem, which is too short for the largest kernel sizes
+        if the signal is short. Run a forward pass on a zero signal to raise a clear error at construction.
+        '''
+        training = self.training
+        self.eval()
+        try:
+            with torch.no_grad():
+                self(torch.zeros(1, in_channel, signal_size))
+        except RuntimeError:
+            raise Exception("The shared stem reduces the signal to {} samples, which is too short for the kernel "
+                            "sizes {}. Use a larger --signal_size (e.g. 2048) or --backbone multi_branch.".format(
+                            signal_size // self.stem.pool.stride, self.window_sizes))
+        finally:
+            self.train(training)
+
+    def branch_inputs(self, input):
+        '''
+        Input of every branch, which is the output of its kernel size in the stem if shared_stem.
+        '''
+        if self.stem is None:
+            return [input] * len(self.convs)
+        out = checkpoint_forward(self.stem, input) if self._checkpointing() else self.stem(input)
+        c = self.stem.out_channels
+        return [out[:, i*c:(i+1)*c] for i in range(len(self.convs))]
+
+    def _checkpointing(self):
+        return self.checkpoint != 'none' and self.training and torch.is_grad_enabled()
+
+    def _branch(self, conv, x):
+        '''
+        Output of a branch, which runs the layers of conv.fs, with the checkpointing option.
+        '''
+        if not self._checkpointing():
+            return conv(x)
+        if self.checkpoint == 'branch':
+            return checkpoint_forward(conv, x)
+        for layer in conv.fs:
+            x = checkpoint_forward(layer, x)
+        return x
 
     def forward(self, input):
-        out = [conv(input) for conv in self.convs]
+        out = [self._branch(conv, x) for conv, x in zip(self.convs, self.branch_inputs(input))]
         out = torch.cat(out, dim=1)
         out = self.fl(out)
         
@@ -120,12 +416,15 @@ class BaseModel(nn.Module):
     def __init__(self,
                  input_size,
                  num_classes,
-                 dropout):
+                 dropout,
+                 rank=0,
+                 **kwargs):
         super(BaseModel, self).__init__()
         
-        self.G = FeatureExtractor(in_channel=input_size, dropout=dropout)
+        # kwargs: Options of the FeatureExtractor, such as shared_stem
+        self.G = FeatureExtractor(in_channel=input_size, dropout=dropout, **kwargs)
         
-        self.C = ClassifierMLP(2560, num_classes, dropout, last=None)
+        self.C = ClassifierMLP(2560, num_classes, dropout, last=None, rank=rank)
         
     def forward(self, input):
         f = self.G(input)
@@ -1,6 +1,6 @@
 import argparse
 
-def parse_args():
+def get_parser():
     parser = argparse.ArgumentParser(description='From github.com/Feaxure-fresh/TL-Bearing-Fault-Diagnosis')
  
     # basic parameters
@@ -47,11 +47,64 @@ def parse_args():
     parser.add_argument('--tradeoff', type=list, default=['exp', 'exp', 'exp'],
                         help='Trade-off coefficients for the sum of losses, integer or "exp" ("exp" represents an increase from 0 to 1)')
     parser.add_argument('--dropout', type=float, default=0., help='Dropout layer coefficient')
+    parser.add_argument('--backbone', type=str, choices=['multi_branch', 'shared_stem'], default='multi_branch',
+                        help='Feature extractor ("shared_stem" shares the first layer of the branches and runs them at 1/4 of the length, which needs --signal_size >= 2048 with the default kernel sizes)')
+    parser.add_argument('--checkpoint', type=str, choices=['none', 'branch', 'layer'], default='none',
+                        help='Activation checkpointing of the feature extractor in training, per branch or per layer of the branches (saves memory at the cost of recomputing the forward pass)')
+    parser.add_argument('--head_rank', type=int, default=0,
+                        help='Rank of the factorized Linear layers of the classifiers and discriminators (0 means dense layers)')
+    parser.add_argument('--conv_backend', type=str, choices=['direct', 'im2col', 'fft', 'auto'], default='direct',
+                        help='Implementation of the Conv1d layers ("auto" benchmarks every backend for each layer shape at the first forward pass and keeps the fastest)')
+    parser.add_argument('--mmd_estimator', type=str, choices=['quadratic', 'linear_time', 'rff'], default='quadratic',
+                        help='Estimator of the MK-MMD loss, on the full kernel matrices, on disjoint pairs of samples or on random Fourier features (the last two are linear in the batch size)')
+    parser.add_argument('--mmd_features', type=int, default=1024, help='Number of random Fourier features of each kernel of the "rff" estimator')
+    parser.add_argument('--mmd_tile_size', type=int, default=0,
+                        help='Number of rows of the MK-MMD kernel matrices computed at a time, recomputed in the backward pass for memory linear in the batch size (0 means the full matrices)')
+    
+    # knowledge distillation (model_name KD)
+    parser.add_argument('--teacher_name', type=str, default='DANN',
+                        help='Name of the teacher model (in ./models directory)')
+    parser.add_argument('--teacher_path', type=str, default='',
+                        help='Trained checkpoint of the teacher model')
+    parser.add_argument('--student_kernel', type=int, default=32,
+                        help='Kernel size of the single-branch student')
+    parser.add_argument('--kd_temperature', type=float, default=4., help='Temperature of the teacher soft labels')
+    
+    # correlation alignment (model_name CORAL)
+    parser.add_argument('--coral_momentum', type=float, default=0.,
+                        help='Weight of the current batch in the running covariances (0 means the covariances of the batch only)')
+    parser.add_argument('--coral_sketch_size', type=int, default=256,
+                        help='Number of random projections of the running covariances')
+    
+    # conditional discriminator input (model_name CDAN, ACDANN)
+    parser.add_argument('--multilinear', type=str, choices=['full', 'randomized', 'factorized'], default='full',
+                        help='Input of the conditional discriminator: outer product of the predictions and the features, or the approximations by fixed random projections of both or by learned rank-1 Linear units on the outer product (which do not scale with the number of classes)')
+    parser.add_argument('--multilinear_dim', type=int, default=1024,
+                        help='Output dimension of the "randomized" and "factorized" maps')
+    
+    # meta-learning domain generalization (model_name MLDG)
+    parser.add_argument('--mldg_order', type=str, choices=['first', 'second'], default='second',
+                        help='Backpropagate the meta-test loss through the inner SGD step ("second") or treat the step as a constant ("first", no second-order graph); the inner step uses the lr, weight decay and momentum of --opt sgd, which MLDG requires')
+    
+    # maximum classifier discrepancy (model_name MCD)
+    parser.add_argument('--mcd_generator_steps', type=int, default=4,
+                        help='Number of feature extractor updates minimizing the discrepancy per iteration')
+    
+    # batch spectral penalization (model_name BSP)
+    parser.add_argument('--bsp_solver', type=str, choices=['svd', 'power', 'lowrank'], default='power',
+                        help='Top singular values from the full SVD, from power iteration warm-started from the previous step, or from torch.svd_lowrank')
+    parser.add_argument('--bsp_k', type=int, default=1, help='Number of penalized singular values')
+    parser.add_argument('--bsp_power_iters', type=int, default=2, help='Number of power iterations per step')
     
     # save and load
     parser.add_argument('--save', type=bool, default=True, help='Save logs and trained model checkpoints')
     parser.add_argument('--load_path', type=str, default='',
                         help='Load trained model checkpoints from this path (for testing, not for resuming training)')
+    return parser
+
+
+def parse_args():
+    parser = get_parser()
     args = parser.parse_args()
     return args
     
@@ -0,0 +1,235 @@
+'''
+Bulk offline inference over directories of raw recordings.
+Every file under --input_dir is read with a reader of data_loader/load_methods.py (--reader), cut into
+windows of --signal_size samples every --hop samples and normalized as in the datasets, and the windows
+are classified in batches. The files are distributed over a pool of --num_workers processes, each holding
+one model and one file at a time. The results are written as they arrive, in chunks of --chunk_size rows, so
+the memory does not grow with the size of the archive.
+
+Two tables are written to --output_dir, as compressed numpy column arrays (one file per chunk, windows_00000.npz,
+windows_00001.npz, ... and files_00000.npz, ...) or as parquet files with one row group per chunk
+(--output_format parquet, which needs pyarrow):
+    windows: file_index (row in files), start (first sample), label, probability of every class (float16)
+    files: path, num_windows, label, fault, confidence (fraction of the votes with --aggregate majority,
+           mean probability with --aggregate mean)
+With --mc_samples, the probabilities are the predictive means of MC dropout (see inference_utils.MCDropoutModel),
+and the predictive entropy and mutual information of every window, and the mean mutual information of every
+file, are added to the tables.
+
+Example: Score an archive of CWRU recordings with a DANN model trained from condition 0 to condition 1.
+python predict.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --input_dir ./archive --reader CWRU
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import time
+import torch
+import logging
+import numpy as np
+import pandas as pd
+import multiprocessing
+from tqdm import tqdm
+
+import load_methods
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--input_dir', type=str, required=True, help='Directory of the raw recordings')
+    parser.add_argument('--reader', type=str, default='',
+                        help="Function of load_methods.py that reads a file ('' means the dataset of --target)")
+    parser.add_argument('--hop', type=int, default=0,
+                        help='Number of samples between the starts of consecutive windows (0 means --signal_size)')
+    parser.add_argument('--aggregate', type=str, choices=['majority', 'mean'], default='mean',
+                        help='Prediction of a file by majority vote or mean probability of its windows')
+    parser.add_argument('--output_dir', type=str, default='./predictions', help='Directory of the output tables')
+    parser.add_argument('--output_format', type=str, choices=['npz', 'parquet'], default='npz',
+                        help='Format of the output tables')
+    parser.add_argument('--cascade_path', type=str, default='',
+                        help='Auxiliary head of cascade.py for early exit (only with a trainer checkpoint)')
+    parser.add_argument('--chunk_size', type=int, default=100000,
+                        help='Number of rows of the output tables held in memory before they are written')
+    parser.add_argument('--mc_samples', type=int, default=0,
+                        help='Number of MC dropout passes for the uncertainty of the windows (0 means deterministic)')
+    args = parser.parse_args()
+    return args
+
+
+# Model and options of a worker process
+worker = {}
+
+
+def init_worker(args, num_threads):
+    torch.set_num_threads(num_threads)
+    device = torch.device("cuda:" + args.cuda_device) if args.cuda_device else torch.device("cpu")
+    worker['model'] = inference_utils.load_inference_model(args, device)
+    if args.mc_samples > 0:
+        worker['model'] = inference_utils.MCDropoutModel(worker['model'], args.mc_samples)
+    worker['args'], worker['device'] = args, device
+    worker['reader'] = getattr(load_methods, args.reader)
+
+
+def predict_file(path):
+    '''
+    First samples, class probabilities, entropy and mutual information (with --mc_samples) of the windows of
+    a file, or the error raised while reading it.
+    '''
+    args, model = worker['args'], worker['model']
+    try:
+        signal = np.asarray(worker['reader'](path), dtype=np.float32).reshape(-1)
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+    signal = torch.from_numpy(signal)
+    if len(signal) < args.signal_size:
+        return path, (np.zeros(0, dtype=np.int64), np.zeros((0, args.num_classes), dtype=np.float16),
+                      np.zeros(0, dtype=np.float16), np.zeros(0, dtype=np.float16)), None
+    windows = signal.unfold(0, args.signal_size, args.hop).unsqueeze(1)
+    outputs = [[], [], []]
+    with torch.no_grad():
+        for batch in windows.split(args.batch_size):
+            batch = batch.to(worker['device'])
+            scale, offset = inference_utils.get_normalization(batch, args.normlizetype)
+            batch = batch * scale + offset
+            if args.mc_samples > 0:
+                results = model.predict(batch)
+            else:
+                results = (torch.softmax(model(batch), dim=1), torch.zeros(len(batch)), torch.zeros(len(batch)))
+            for out, result in zip(outputs, results):
+                out.append(result.cpu())
+    starts = np.arange(len(windows), dtype=np.int64) * args.hop
+    return path, (starts, *[torch.cat(out).numpy().astype(np.float16) for out in outputs]), None
+
+
+def aggregate(probabilities, method):
+    '''
+    Label and confidence of a file from the class probabilities of its windows.
+    '''
+    if method == 'majority':
+        votes = np.bincount(probabilities.argmax(axis=1), minlength=probabilities.shape[1])
+        return int(votes.argmax()), float(votes.max() / votes.sum())
+    mean = probabilities.astype(np.float32).mean(axis=0)
+    return int(mean.argmax()), float(mean.max())
+
+
+class TableWriter(object):
+    '''
+    Table written in chunks of chunk_size rows as it is filled, so that only one chunk is held in memory: row groups
+    of one parquet file (path.parquet), or numbered npz files (path_00000.npz, path_00001.npz, ...).
+    columns: Empty array of every column, with its dtype (and number of classes for 2-d columns).
+    '''
+    def __init__(self, path, output_format, chunk_size, columns):
+        self.path, self.output_format, self.chunk_size = path, output_format, chunk_size
+        self.empty = columns
+        self.buffer = {k: [] for k in columns}
+        self.buffered, self.num_chunks, self.num_rows = 0, 0, 0
+        self.writer = None
+
+    def __len__(self):
+        return self.num_rows + self.buffered
+
+    def append(self, columns):
+        for k, v in columns.items():
+            # Strings keep their own length
+            dtype = str if self.empty[k].dtype.kind == 'U' else self.empty[k].dtype
+            self.buffer[k].append(np.asarray(v, dtype=dtype))
+        self.buffered += len(next(iter(columns.values())))
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        columns = {k: np.concatenate([self.empty[k]] + v) for k, v in self.buffer.items()}
+        if self.output_format == 'npz':
+            np.savez_compressed('{}_{:05d}.npz'.format(self.path, self.num_chunks), **columns)
+        else:
+            import pyarrow.parquet
+            data = {k: v for k, v in columns.items() if v.ndim == 1}
+            for k, v in columns.items():
+                if v.ndim == 2:
+                    data.update({'{}_{}'.format(k, i): v[:, i] for i in range(v.shape[1])})
+            table = pyarrow.Table.from_pandas(pd.DataFrame(data), preserve_index=False)
+            if self.writer is None:
+                self.writer = pyarrow.parquet.ParquetWriter(self.path + '.parquet', table.schema)
+            self.writer.write_table(table)
+        self.num_rows += self.buffered
+        self.num_chunks += 1
+        self.buffer = {k: [] for k in self.buffer}
+        self.buffered = 0
+
+    def close(self):
+        # An empty table is still written if no row was
+        if self.buffered > 0 or self.num_chunks == 0:
+            self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    args = inference_utils.prepare_args(args)
+    args.reader = args.reader if args.reader else args.target.split('_')[0]
+    args.hop = args.hop if args.hop > 0 else args.signal_size
+    if args.output_format == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("The parquet output needs pyarrow, use --output_format npz or install pyarrow.")
+
+    paths = sorted([os.path.join(root, name) for root, _, names in os.walk(args.input_dir) for name in names])
+    logging.info('Found {} files in {}'.format(len(paths), args.input_dir))
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    file_columns = {'path': np.zeros(0, dtype=str), 'num_windows': np.zeros(0, dtype=np.int64),
+                    'label': np.zeros(0, dtype=np.int64), 'fault': np.zeros(0, dtype=str),
+                    'confidence': np.zeros(0, dtype=np.float64)}
+    window_columns = {'file_index': np.zeros(0, dtype=np.int32), 'start': np.zeros(0, dtype=np.int64),
+                      'label': np.zeros(0, dtype=np.int16),
+                      'probability': np.zeros((0, args.num_classes), dtype=np.float16)}
+    if args.mc_samples > 0:
+        file_columns['mutual_information'] = np.zeros(0, dtype=np.float64)
+        window_columns.update({'entropy': np.zeros(0, dtype=np.float16),
+                               'mutual_information': np.zeros(0, dtype=np.float16)})
+    files = TableWriter(os.path.join(args.output_dir, 'files'), args.output_format, args.chunk_size, file_columns)
+    windows = TableWriter(os.path.join(args.output_dir, 'windows'), args.output_format, args.chunk_size,
+                          window_columns)
+    errors = 0
+    start = time.perf_counter()
+    num_workers = max(args.num_workers, 1)
+    num_threads = max(torch.get_num_threads() // num_workers, 1)
+    if args.num_workers > 0:
+        pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker,
+                                                         initargs=(args, num_threads))
+        results = pool.imap(predict_file, paths)
+    else:
+        init_worker(args, num_threads)
+        results = map(predict_file, paths)
+
+    for path, result, error in tqdm(results, total=len(paths), ascii=True):
+        if error is not None:
+            logging.info('Skipping {} ({})'.format(path, error))
+            errors += 1
+            continue
+        starts, probabilities, entropy, mutual_information = result
+        label, confidence = aggregate(probabilities, args.aggregate) if len(starts) > 0 else (-1, 0.)
+        window_rows = {'file_index': np.full(len(starts), len(files), dtype=np.int32),
+                       'start': starts, 'label': probabilities.argmax(axis=1), 'probability': probabilities}
+        file_row = {'path': [os.path.relpath(path, args.input_dir)], 'num_windows': [len(starts)], 'label': [label],
+                    'fault': [args.faults[label] if label >= 0 else ''], 'confidence': [confidence]}
+        if args.mc_samples > 0:
+            window_rows.update({'entropy': entropy, 'mutual_information': mutual_information})
+            file_row['mutual_information'] = [float(mutual_information.astype(np.float32).mean())
+                                              if len(starts) > 0 else 0.]
+        windows.append(window_rows)
+        files.append(file_row)
+    if args.num_workers > 0:
+        pool.close()
+        pool.join()
+    windows.close()
+    files.close()
+    elapsed = time.perf_counter() - start
+    logging.info('{} files ({} skipped) and {} windows in {:.2f} s ({:.0f} windows/s), saved to {}'.format(
+                 len(files), errors, len(windows), elapsed, len(windows) / elapsed, args.output_dir))
+    logger.handlers.clear()
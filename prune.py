@@ -0,0 +1,240 @@
+'''
+Structured branch and channel pruning of the multi-branch feature extractor.
+The importance of every branch (increase of the validation loss when it is removed) and of every conv
+channel (mean activation after ReLU) is measured on the target validation set. Low-value branches and
+channels are removed, the input of the classifier heads is shrunk to match, and each pruned model is
+fine-tuned briefly. The accuracy and latency of every pruned configuration form a trade-off curve, and
+the fastest configuration within --max_acc_drop of the original accuracy is saved.
+
+Example: Prune an MCD model trained from CWRU operation condition 0 to condition 1.
+python prune.py --model_name MCD --load_path ./ckpt/MCD/single_source/**.pth --source CWRU_0 --target CWRU_1
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import copy
+import json
+import torch
+import logging
+import torch.nn as nn
+import torch.nn.functional as F
+
+import model_base
+import inference_utils
+from opt import get_parser
+
+
+# Indexes of the conv layers in CNNlayer.fs (index 4 is the dropout layer)
+CONV_LAYERS = [0, 1, 2, 3, 5]
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--keep_ratios', type=str, default='1.0,0.75,0.5,0.25',
+                        help='Ratios of conv channels to keep, separated by ","')
+    parser.add_argument('--min_branches', type=int, default=1, help='Minimum number of branches to keep')
+    parser.add_argument('--prune_epochs', type=int, default=1, help='Epochs of fine-tuning after pruning')
+    parser.add_argument('--prune_lr', type=float, default=1e-3, help='Learning rate of fine-tuning after pruning')
+    parser.add_argument('--max_acc_drop', type=float, default=0.01,
+                        help='Maximum drop of validation accuracy of the saved model')
+    args = parser.parse_args()
+    return args
+
+
+def validation_loss(model, dataloader, device):
+    model.eval()
+    loss = 0.0
+    with torch.no_grad():
+        for data, labels, _ in dataloader:
+            loss += F.cross_entropy(model(data.to(device)), labels.to(device)).item()
+    return loss / len(dataloader)
+
+
+def branch_importance(model, dataloader, device):
+    '''
+    Increase of the validation loss when the output of each branch is set to zero.
+    '''
+    base_loss = validation_loss(model, dataloader, device)
+    importance = []
+    for conv in model.G.convs:
+        handle = conv.register_forward_hook(lambda module, input, output: torch.zeros_like(output))
+        importance.append(validation_loss(model, dataloader, device) - base_loss)
+        handle.remove()
+    return importance
+
+
+def channel_importance(model, dataloader, device):
+    '''
+    Mean activation after ReLU of every channel of every conv layer, as [branch][layer] tensors.
+    '''
+    importance = [[0. for _ in CONV_LAYERS] for _ in model.G.convs]
+    handles = []
+    for b, conv in enumerate(model.G.convs):
+        for l, idx in enumerate(CONV_LAYERS):
+            def hook(module, input, b=b, l=l):
+                importance[b][l] += input[0].detach().mean(dim=(0, 2)).cpu()
+            # The pooling layer receives the output of ReLU
+            handles.append(conv.fs[idx][3].register_forward_pre_hook(hook))
+    model.eval()
+    with torch.no_grad():
+        for data, _, _ in dataloader:
+            model(data.to(device))
+    for handle in handles:
+        handle.remove()
+    return importance
+
+
+def prune_linear_input(fc, features):
+    '''
+    Copy of an nn.Linear, StackedLinear or LowRankLinear layer that only keeps the given input features.
+    '''
+    if isinstance(fc, model_base.LowRankLinear):
+        new_fc = copy.deepcopy(fc)
+        new_fc.U = prune_linear_input(fc.U, features)
+        new_fc.in_features = len(features)
+        return new_fc
+    if isinstance(fc, model_base.StackedLinear):
+        new_fc = model_base.StackedLinear(fc.num_heads, len(features), fc.out_features, bias=fc.bias is not None)
+    else:
+        new_fc = nn.Linear(len(features), fc.out_features, bias=fc.bias is not None)
+    new_fc = new_fc.to(fc.weight.device)
+    with torch.no_grad():
+        # Both nn.Linear (out, in) and StackedLinear (heads, in, out) store the inputs in dim 1
+        new_fc.weight.copy_(fc.weight[:, features])
+        if fc.bias is not None:
+            new_fc.bias.copy_(fc.bias)
+    return new_fc
+
+
+def prune_model(model, branches, ratio, importance):
+    '''
+    Build a smaller InferenceModel that keeps the given branches and the most important ratio of the
+    channels of each conv layer. The first Linear layer of every head only keeps the matching inputs.
+    '''
+    G = model.G
+    old_channels = [G.convs[0].fs[idx][0].out_channels for idx in CONV_LAYERS]
+    channels = [max(1, int(round(c * ratio))) for c in old_channels]
+    window_sizes = [G.convs[b].fs[0][0].kernel_size[0] for b in branches]
+    in_channel = G.convs[0].fs[0][0].in_channels
+    device = next(G.parameters()).device
+    new_G = model_base.FeatureExtractor(in_channel=in_channel, window_sizes=window_sizes,
+                                        channels=channels).to(device)
+
+    features = []
+    branch_size = old_channels[-1] * 4
+    with torch.no_grad():
+        for nb, b in enumerate(branches):
+            old_fs, new_fs = G.convs[b].fs, new_G.convs[nb].fs
+            kept_in = None
+            for l, idx in enumerate(CONV_LAYERS):
+                kept = importance[b][l].topk(channels[l]).indices.sort().values.to(device)
+                old_conv, old_bn = old_fs[idx][0], old_fs[idx][1]
+                new_conv, new_bn = new_fs[idx][0], new_fs[idx][1]
+                weight = old_conv.weight[kept]
+                new_conv.weight.copy_(weight if kept_in is None else weight[:, kept_in])
+                new_conv.bias.copy_(old_conv.bias[kept])
+                for name in ['weight', 'bias', 'running_mean', 'running_var']:
+                    getattr(new_bn, name).copy_(getattr(old_bn, name)[kept])
+                kept_in = kept
+            # The output of a branch is flattened from (channels, 4)
+            features.append(b * branch_size + (kept_in.unsqueeze(1) * 4 + torch.arange(4, device=device)).flatten())
+    features = torch.cat(features)
+
+    heads = copy.deepcopy(model.heads)
+    for C in ([heads] if isinstance(heads, model_base.StackedClassifierMLP) else heads):
+        C.net[1] = prune_linear_input(C.net[1], features)
+    return inference_utils.InferenceModel(new_G, heads, combine=model.combine).eval()
+
+
+def build_pruned_model(config):
+    '''
+    Rebuild a pruned model from the config saved with its weights.
+    '''
+    G = model_base.FeatureExtractor(in_channel=config['in_channel'], window_sizes=config['window_sizes'],
+                                    channels=config['channels'])
+    features = torch.arange(config['feature_size'])
+    rank = config.get('rank', 0)
+    if config.get('stacked', False):
+        heads = model_base.StackedClassifierMLP(config['num_heads'], config['input_size'],
+                                                config['num_classes'], 0., last=None, rank=rank)
+        heads.net[1] = prune_linear_input(heads.net[1], features)
+    else:
+        heads = []
+        for _ in range(config['num_heads']):
+            C = model_base.ClassifierMLP(config['input_size'], config['num_classes'], 0., last=None, rank=rank)
+            C.net[1] = prune_linear_input(C.net[1], features)
+            heads.append(C)
+    return inference_utils.InferenceModel(G, heads, combine=config['combine']).eval()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    if args.random_state is not None:
+        torch.manual_seed(args.random_state)
+    args = inference_utils.prepare_args(args)
+
+    trainer = inference_utils.build_trainer(args)
+    model = inference_utils.get_inference_model(trainer)
+    if not all([isinstance(conv, model_base.CNNlayer) for conv in model.G.convs]) or model.G.stem is not None:
+        raise Exception("Only feature extractors built from CNNlayer without a shared stem can be pruned.")
+    device, val_loader = trainer.device, trainer.dataloaders['val']
+    example = next(iter(val_loader))[0][:1].to(device)
+
+    b_importance = branch_importance(model, val_loader, device)
+    c_importance = channel_importance(model, val_loader, device)
+    window_sizes = [conv.fs[0][0].kernel_size[0] for conv in model.G.convs]
+    for h, imp in zip(window_sizes, b_importance):
+        logging.info('Branch with kernel size {}: loss increase {:.4f} when removed'.format(h, imp))
+    order = sorted(range(len(b_importance)), key=lambda b: b_importance[b], reverse=True)
+
+    base = {'window_sizes': window_sizes, 'keep_ratio': 1.0,
+            'accuracy': inference_utils.evaluate(model, val_loader, device),
+            'latency_ms': inference_utils.measure_latency(model, example),
+            'parameters': inference_utils.count_parameters(model)}
+    curve = []
+    best, best_model = None, None
+    ratios = [float(r) for r in args.keep_ratios.split(',')]
+    for num_branches in range(len(order), args.min_branches-1, -1):
+        branches = sorted(order[:num_branches])
+        for ratio in ratios:
+            if num_branches == len(order) and ratio == 1.0:
+                continue
+            pruned = prune_model(model, branches, ratio, c_importance)
+            pruned = inference_utils.finetune(pruned, model, trainer, args.prune_epochs, args.prune_lr)
+            point = {'window_sizes': [window_sizes[b] for b in branches], 'keep_ratio': ratio,
+                     'accuracy': inference_utils.evaluate(pruned, val_loader, device),
+                     'latency_ms': inference_utils.measure_latency(pruned, example),
+                     'parameters': inference_utils.count_parameters(pruned)}
+            logging.info('Kernel sizes {}, channel ratio {}: val-acc {:.4f} ({:+.4f}), latency {:.2f} ms (x{:.2f}), '
+                         'parameters {}'.format(point['window_sizes'], ratio, point['accuracy'],
+                                                point['accuracy'] - base['accuracy'], point['latency_ms'],
+                                                base['latency_ms'] / point['latency_ms'], point['parameters']))
+            curve.append(point)
+            if point['accuracy'] >= base['accuracy'] - args.max_acc_drop and \
+               (best is None or point['latency_ms'] < best['latency_ms']):
+                best, best_model = point, pruned
+
+    base_name = os.path.splitext(args.load_path)[0]
+    with open(base_name + '_prune_report.json', 'w') as f:
+        json.dump({'original': base, 'curve': curve, 'selected': best}, f, indent=4)
+    logging.info('Report saved to {}'.format(base_name + '_prune_report.json'))
+    if best is None:
+        logging.info('No pruned model is within {} of the original accuracy.'.format(args.max_acc_drop))
+    else:
+        stacked = isinstance(best_model.heads, model_base.StackedClassifierMLP)
+        first_fc = lambda heads: heads.net[1] if stacked else heads[0].net[1]
+        input_size, feature_size = first_fc(model.heads).in_features, first_fc(best_model.heads).in_features
+        config = {'in_channel': best_model.G.convs[0].fs[0][0].in_channels,
+                  'window_sizes': best['window_sizes'],
+                  'channels': [best_model.G.convs[0].fs[idx][0].out_channels for idx in CONV_LAYERS],
+                  'input_size': input_size,
+                  'feature_size': feature_size,
+                  'num_heads': len(best_model.heads),
+                  'stacked': stacked,
+                  'rank': args.head_rank,
+                  'num_classes': args.num_classes,
+                  'combine': best_model.combine}
+        torch.save({'config': config, 'model': best_model.state_dict()}, base_name + '_pruned.pth')
+        logging.info('Pruned model saved to {}'.format(base_name + '_pruned.pth'))
+    logger.handlers.clear()
@@ -0,0 +1,129 @@
+'''
+Int8 quantization of trained models for CPU inference.
+The feature extractor is statically quantized with observers calibrated on target-domain windows, and the
+Linear layers of the classifier heads are dynamically quantized. Quantization-aware fine-tuning is optional.
+Every variant is exported as a TorchScript model, with a report of its accuracy and latency change.
+
+Example: Quantize a DANN model trained from CWRU operation condition 0 to condition 1.
+python quantize.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --qat_epochs 2
+'''
+import os
+import copy
+import json
+import torch
+import logging
+import torch.nn as nn
+from torch.ao.quantization import quantize_fx, quantize_dynamic
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--qengine', type=str, choices=['fbgemm', 'qnnpack', 'x86'], default='fbgemm',
+                        help='Backend of the quantized kernels ("fbgemm" for x86 CPUs and "qnnpack" for ARM CPUs)')
+    parser.add_argument('--num_calib_batches', type=int, default=16,
+                        help='Number of target-domain batches used to calibrate the static quantization')
+    parser.add_argument('--qat_epochs', type=int, default=0,
+                        help='Epochs of quantization-aware fine-tuning (0 means no fine-tuning)')
+    parser.add_argument('--qat_lr', type=float, default=1e-4, help='Learning rate of quantization-aware fine-tuning')
+    parser.add_argument('--latency_batch_sizes', type=str, default='1,64',
+                        help='Batch sizes to measure the latency, separated by ","')
+    parser.add_argument('--export_dir', type=str, default='',
+                        help="Directory of the exported models and report ('' means the directory of load_path)")
+    args = parser.parse_args()
+    return args
+
+
+def quantize_heads(model):
+    '''
+    Dynamically quantize the Linear layers of the classifier heads.
+    '''
+    model.heads = quantize_dynamic(model.heads, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def quantize_static(model, dataloader, num_batches, qengine):
+    '''
+    Statically quantize the feature extractor, with observers calibrated on num_batches of the dataloader.
+    '''
+    model = copy.deepcopy(model).eval()
+    example = next(iter(dataloader))[0]
+    prepared = quantize_fx.prepare_fx(model.G, get_default_qconfig_mapping(qengine), (example,))
+    with torch.no_grad():
+        for i, (data, _, _) in enumerate(dataloader):
+            if i >= num_batches:
+                break
+            prepared(data)
+    model.G = quantize_fx.convert_fx(prepared)
+    return quantize_heads(model)
+
+
+def quantize_aware_finetune(model, trainer, args):
+    '''
+    Fine-tune the model with fake quantization of the feature extractor and convert it to int8.
+    '''
+    qat_model = copy.deepcopy(model).train()
+    example = next(iter(trainer.dataloaders['train']))[0]
+    qat_model.G = quantize_fx.prepare_qat_fx(qat_model.G, get_default_qat_qconfig_mapping(args.qengine), (example,))
+    qat_model = inference_utils.finetune(qat_model, model, trainer, args.qat_epochs, args.qat_lr)
+    qat_model.G = quantize_fx.convert_fx(qat_model.G)
+    return quantize_heads(qat_model)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    if args.random_state is not None:
+        torch.manual_seed(args.random_state)
+    # Quantized kernels only run on the CPU
+    args.cuda_device = ''
+    torch.backends.quantized.engine = args.qengine
+    args = inference_utils.prepare_args(args)
+
+    trainer = inference_utils.build_trainer(args)
+    model = inference_utils.get_inference_model(trainer)
+    val_loader = trainer.dataloaders['val']
+
+    variants = {'fp32': model,
+                'dynamic': quantize_heads(copy.deepcopy(model)),
+                'static': quantize_static(model, trainer.dataloaders['train'], args.num_calib_batches, args.qengine)}
+    if args.qat_epochs > 0:
+        variants['qat'] = quantize_aware_finetune(model, trainer, args)
+
+    export_dir = args.export_dir if args.export_dir else os.path.dirname(args.load_path)
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    base_name = os.path.splitext(os.path.basename(args.load_path))[0]
+    example = next(iter(val_loader))[0]
+    batch_sizes = [int(b) for b in args.latency_batch_sizes.split(',')]
+
+    report = {}
+    for name, variant in variants.items():
+        path = os.path.join(export_dir, '{}_{}.pt'.format(base_name, name))
+        with torch.no_grad():
+            exported = torch.jit.trace(variant.eval(), example)
+        torch.jit.save(exported, path)
+        report[name] = {'path': path,
+                        'size_mb': inference_utils.model_size(path),
+                        'accuracy': inference_utils.evaluate(exported, val_loader, trainer.device)}
+        for bs in batch_sizes:
+            input = torch.randn(bs, *example.shape[1:])
+            report[name]['latency_ms_bs%d' % bs] = inference_utils.measure_latency(exported, input)
+
+    for name, item in report.items():
+        item['accuracy_change'] = item['accuracy'] - report['fp32']['accuracy']
+        for bs in batch_sizes:
+            item['speedup_bs%d' % bs] = report['fp32']['latency_ms_bs%d' % bs] / item['latency_ms_bs%d' % bs]
+        logging.info('{}: val-acc {:.4f} ({:+.4f}), size {:.2f} MB, '.format(
+            name, item['accuracy'], item['accuracy_change'], item['size_mb']) + ', '.join(
+            ['latency bs{} {:.2f} ms (x{:.2f})'.format(bs, item['latency_ms_bs%d' % bs], item['speedup_bs%d' % bs])
+             for bs in batch_sizes]))
+
+    report_path = os.path.join(export_dir, base_name + '_quant_report.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    logging.info('Report saved to {}'.format(report_path))
+    logger.handlers.clear()
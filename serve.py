@@ -0,0 +1,289 @@
+'''
+Local HTTP inference server with dynamic micro-batching.
+Concurrent requests are queued and coalesced into one batch, which is run as soon as it is full
+(--max_batch) or when its oldest request has waited --max_delay_ms, so that many clients with single
+windows share the throughput of batched inference under a bounded latency.
+
+Endpoints:
+    POST /predict  One raw window, as a JSON list of samples or as little-endian float32 bytes
+                   (Content-Type: application/octet-stream). It is normalized as in the datasets.
+                   Returns {"label", "fault", "probabilities"}.
+    GET /metrics   Number of requests, p50/p99 latency in ms, mean batch size and batch fill (over the last
+                   --metrics_window requests and batches).
+Malformed requests are answered with 400 and an error message, and failures of the model with 500.
+
+The model is a trainer checkpoint (--load_path **.pth), a pruned model (**_pruned.pth), or a TorchScript
+export of quantize.py (**.pt), optionally with the early exit of cascade.py (--cascade_path), see
+inference_utils.load_inference_model.
+With --clients > 0, a local load generator sends the target validation windows from that many concurrent
+clients to the server and reports the latency, batch fill and accuracy.
+
+Example: Serve a DANN model trained from CWRU operation condition 0 to condition 1, and load-test it.
+python serve.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --clients 64
+'''
+import sys
+sys.path.extend(['./models', './data_loader'])
+import copy
+import time
+import json
+import torch
+import asyncio
+import logging
+import collections
+import numpy as np
+import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
+
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host of the server')
+    parser.add_argument('--port', type=int, default=8000, help='Port of the server')
+    parser.add_argument('--max_batch', type=int, default=64, help='Maximum number of windows in a batch')
+    parser.add_argument('--max_delay_ms', type=float, default=5.,
+                        help='Maximum time in ms that a request waits for other requests to fill its batch')
+    parser.add_argument('--metrics_window', type=int, default=10000,
+                        help='Number of most recent requests and batches over which /metrics computes the latency and batch size')
+    parser.add_argument('--cascade_path', type=str, default='',
+                        help='Auxiliary head of cascade.py for early exit (only with a trainer checkpoint)')
+    parser.add_argument('--clients', type=int, default=0,
+                        help='Number of concurrent clients of the local load generator (0 means only serving)')
+    parser.add_argument('--requests_per_client', type=int, default=100,
+                        help='Number of requests sent by each client of the load generator')
+    args = parser.parse_args()
+    return args
+
+
+class MicroBatcher(object):
+    '''
+    Queue of single windows, which are classified in batches of at most max_batch windows. A batch is run
+    when it is full or max_delay seconds after its first request arrived.
+    '''
+    def __init__(self, model, device, max_batch, max_delay, norm_type, metrics_window=10000):
+        self.model, self.device = model, device
+        self.max_batch, self.max_delay, self.norm_type = max_batch, max_delay, norm_type
+        self.queue = asyncio.Queue()
+        # One inference thread, so that the event loop collects the next batch while the current one runs
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Latencies and batch sizes of the most recent requests and batches only, so that a long-running server
+        # keeps a bounded memory
+        self.latencies = collections.deque(maxlen=metrics_window)
+        self.batch_sizes = collections.deque(maxlen=metrics_window)
+        self.num_requests = 0
+
+    async def predict(self, window):
+        '''
+        Class probabilities of a window (channels, samples).
+        '''
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self.queue.put((window, future))
+        probabilities = await future
+        self.latencies.append((time.perf_counter() - start) * 1000)
+        self.num_requests += 1
+        return probabilities
+
+    def _infer(self, windows):
+        input = torch.stack(windows).to(self.device)
+        scale, offset = inference_utils.get_normalization(input, self.norm_type)
+        with torch.no_grad():
+            return F.softmax(self.model(input * scale + offset), dim=1).cpu()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            windows, futures = zip(*batch)
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self._infer, list(windows))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batch_sizes.append(len(batch))
+            for future, p in zip(futures, probabilities):
+                future.set_result(p)
+
+    def metrics(self):
+        if not self.latencies:
+            return {'requests': 0}
+        return {'requests': self.num_requests,
+                'latency_p50_ms': float(np.percentile(self.latencies, 50)),
+                'latency_p99_ms': float(np.percentile(self.latencies, 99)),
+                'mean_batch_size': float(np.mean(self.batch_sizes)),
+                'batch_fill': float(np.mean(self.batch_sizes)) / self.max_batch}
+
+
+class Server(object):
+    '''
+    Minimal HTTP/1.1 server (with keep-alive) in front of a MicroBatcher.
+    '''
+    def __init__(self, batcher, faults, signal_size):
+        self.batcher, self.faults, self.signal_size = batcher, faults, signal_size
+
+    async def respond(self, writer, status, response):
+        payload = json.dumps(response).encode()
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                     status, len(payload)).encode() + payload)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                try:
+                    lines = header.decode('latin-1').split('\r\n')
+                    method, path = lines[0].split(' ')[:2]
+                    headers = {k.strip().lower(): v.strip() for k, v in
+                               [line.split(':', 1) for line in lines[1:] if ':' in line]}
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError as e:
+                    # The end of the request is unknown, so the connection is closed after the response
+                    await self.respond(writer, '400 Bad Request', {'error': 'malformed request: {}'.format(e)})
+                    break
+                # Largest body read, so that a client cannot make the server buffer any size it announces: the
+                # float32 bytes of a window, or a JSON list of numbers of at most 32 characters each (json.dumps
+                # writes a float in at most 24), plus a margin for brackets and whitespace
+                binary = headers.get('content-type', '') == 'application/octet-stream'
+                max_body = self.signal_size * (4 if binary else 32) + 1024
+                if length > max_body:
+                    # The body is not read, so the connection is closed after the response
+                    await self.respond(writer, '413 Payload Too Large',
+                                       {'error': 'the body has {} bytes, at most {} are accepted'.format(length, max_body)})
+                    break
+                try:
+                    body = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                status, response = await self.route(method, path, headers, body)
+                await self.respond(writer, status, response)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, headers, body):
+        if method == 'GET' and path == '/metrics':
+            return '200 OK', self.batcher.metrics()
+        if method != 'POST' or path != '/predict':
+            return '404 Not Found', {'error': 'unknown endpoint {} {}'.format(method, path)}
+        try:
+            if headers.get('content-type', '') == 'application/octet-stream':
+                window = torch.from_numpy(np.frombuffer(body, dtype='<f4').copy())
+            else:
+                window = torch.tensor(json.loads(body), dtype=torch.float32)
+        except (ValueError, TypeError, RuntimeError) as e:
+            # Bad JSON, or a body that is not a list of numbers (e.g. ragged lists)
+            return '400 Bad Request', {'error': 'invalid window: {}'.format(e)}
+        if window.dim() != 1 or len(window) != self.signal_size:
+            return '400 Bad Request', {'error': 'a window must have {} samples'.format(self.signal_size)}
+        if not torch.isfinite(window).all():
+            return '400 Bad Request', {'error': 'the window has NaN or infinite samples'}
+        try:
+            probabilities = await self.batcher.predict(window.unsqueeze(0))
+        except Exception as e:
+            return '500 Internal Server Error', {'error': '{}: {}'.format(type(e).__name__, e)}
+        if not torch.isfinite(probabilities).all():
+            # The normalization divides by the range or the standard deviation of the window, as in training
+            return '400 Bad Request', {'error': 'the window cannot be normalized (e.g. a constant window)'}
+        label = int(probabilities.argmax())
+        return '200 OK', {'label': label, 'fault': self.faults[label], 'probabilities': probabilities.tolist()}
+
+
+async def client(host, port, windows, labels, latencies):
+    '''
+    Send windows one by one over a keep-alive connection and count the correct predictions.
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    correct = 0
+    for window, label in zip(windows, labels):
+        body = window.numpy().astype('<f4').tobytes()
+        start = time.perf_counter()
+        writer.write('POST /predict HTTP/1.1\r\nContent-Type: application/octet-stream\r\nContent-Length: {}\r\n\r\n'.format(
+                     len(body)).encode() + body)
+        await writer.drain()
+        header = await reader.readuntil(b'\r\n\r\n')
+        length = [int(line.split(b':')[1]) for line in header.split(b'\r\n') if line.lower().startswith(b'content-length')][0]
+        response = json.loads(await reader.readexactly(length))
+        latencies.append((time.perf_counter() - start) * 1000)
+        correct += int(response['label'] == int(label))
+    writer.close()
+    return correct
+
+
+async def load_test(args, server, batcher):
+    '''
+    Run the server and the load generator in the same event loop.
+    '''
+    # Only the datasets are needed, the model may not be a trainer checkpoint
+    data_args = copy.copy(args)
+    data_args.load_path = ''
+    trainer = inference_utils.build_trainer(data_args)
+    windows, labels = zip(*[(data, label) for data, label, _ in trainer.datasets['val']])
+    windows, labels = torch.stack([torch.as_tensor(w).flatten() for w in windows]), torch.as_tensor(labels)
+
+    tcp = await asyncio.start_server(server.handle, args.host, args.port)
+    worker = asyncio.create_task(batcher.run())
+    latencies = []
+    start = time.perf_counter()
+    jobs = []
+    for c in range(args.clients):
+        idx = torch.randint(len(windows), (args.requests_per_client,))
+        jobs.append(client(args.host, args.port, windows[idx], labels[idx], latencies))
+    correct = sum(await asyncio.gather(*jobs))
+    elapsed = time.perf_counter() - start
+    worker.cancel()
+    tcp.close()
+
+    total = args.clients * args.requests_per_client
+    metrics = batcher.metrics()
+    logging.info('{} clients, {} requests in {:.2f} s: {:.0f} requests/s, accuracy {:.4f}'.format(
+                 args.clients, total, elapsed, total / elapsed, correct / total))
+    logging.info('Client latency: p50 {:.2f} ms, p99 {:.2f} ms'.format(np.percentile(latencies, 50),
+                                                                       np.percentile(latencies, 99)))
+    logging.info('Server latency: p50 {:.2f} ms, p99 {:.2f} ms, mean batch size {:.1f}, batch fill {:.2%}'.format(
+                 metrics['latency_p50_ms'], metrics['latency_p99_ms'], metrics['mean_batch_size'],
+                 metrics['batch_fill']))
+
+
+async def serve(args, server, batcher):
+    tcp = await asyncio.start_server(server.handle, args.host, args.port)
+    logging.info('Serving on http://{}:{}'.format(args.host, args.port))
+    async with tcp:
+        await asyncio.gather(tcp.serve_forever(), batcher.run())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    args = inference_utils.prepare_args(args)
+    device = torch.device("cuda:" + args.cuda_device) if args.cuda_device else torch.device("cpu")
+    model = inference_utils.load_inference_model(args, device)
+
+    batcher = MicroBatcher(model, device, args.max_batch, args.max_delay_ms / 1000, args.normlizetype,
+                           args.metrics_window)
+    server = Server(batcher, args.faults, args.signal_size)
+    if args.clients > 0:
+        asyncio.run(load_test(args, server, batcher))
+    else:
+        asyncio.run(serve(args, server, batcher))
+    logger.handlers.clear()
@@ -0,0 +1,264 @@
+'''
+Streaming inference over a continuous signal with overlapping windows.
+Instead of recomputing every convolution over each window, the layers of the branches run over the stream
+itself: every layer keeps the last kernel_size-1 samples of its input and the unpooled remainder of its output,
+so each hop only computes the new samples. The outputs of the last conv layer are buffered, and every window
+is classified from the adaptive pooling of its span of the buffer. The cost per window therefore scales with
+the hop, not with the window size.
+
+The windowed model pads every layer with zeros and normalizes every window on its own, while the stream is
+normalized once (calibrated on its first window) and the layers see the neighbouring samples instead of the
+padding, so the predictions can differ slightly near the window borders. This script reports the agreement
+with the windowed model and the throughput of both on the raw recordings of the target domain.
+
+Example: Stream the recordings of CWRU operation condition 1 with a hop of 128 samples through a DANN model.
+python streaming.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --hop 128
+'''
+import os
+import sys
+sys.path.extend(['./models', './data_loader'])
+import time
+import torch
+import logging
+import numpy as np
+import torch.nn as nn
+import torch.nn.functional as F
+
+import load_methods
+import inference_utils
+from MixStyle import MixStyle
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--hop', type=int, default=128,
+                        help='Number of samples between the starts of consecutive windows')
+    parser.add_argument('--max_windows', type=int, default=2000,
+                        help='Maximum number of windows streamed from each recording')
+    args = parser.parse_args()
+    return args
+
+
+class StreamingLayer(object):
+    '''
+    Conv1d (stride 1), pointwise layers (BatchNorm and ReLU in eval mode) and an optional MaxPool1d with equal
+    kernel size and stride, evaluated incrementally over a stream.
+    '''
+    def __init__(self, conv, pointwise, pool=None):
+        if conv.stride[0] != 1 or conv.dilation[0] != 1 or conv.groups != 1 or conv.padding_mode != 'zeros':
+            raise Exception("Streaming only supports Conv1d with stride 1, dilation 1, one group and zero padding.")
+        self.conv = conv
+        self.pointwise = pointwise
+        self.pool = pool
+        self.kernel_size, self.padding = conv.kernel_size[0], conv.padding[0]
+        self.pool_size = 1 if pool is None else pool.stride
+
+    def length(self, length):
+        '''
+        Output length of the layer on a window of the given length, as in the windowed model.
+        '''
+        length = length + 2 * self.padding - self.kernel_size + 1
+        return length // self.pool_size
+
+    def reset(self, batch_size, device):
+        # The zero padding on the left of the first window starts the stream
+        self.context = torch.zeros(batch_size, self.conv.in_channels, self.padding, device=device)
+        self.remainder = torch.zeros(batch_size, self.conv.out_channels, 0, device=device)
+
+    def __call__(self, input):
+        input = torch.cat((self.context, input), dim=-1)
+        if input.shape[-1] < self.kernel_size:
+            self.context = input
+            return input.new_zeros(input.shape[0], self.conv.out_channels, 0)
+        self.context = input[..., input.shape[-1] - self.kernel_size + 1:]
+        out = self.pointwise(F.conv1d(input, self.conv.weight, self.conv.bias))
+        if self.pool is None:
+            return out
+        out = torch.cat((self.remainder, out), dim=-1)
+        length = out.shape[-1] // self.pool_size * self.pool_size
+        self.remainder = out[..., length:]
+        return self.pool(out[..., :length])
+
+
+def get_streaming_layers(branch):
+    '''
+    StreamingLayers of a branch (CNNlayer or MixStyleLayer) and the output size of its adaptive pooling.
+    '''
+    layers, output_size = [], None
+    for module in branch.fs:
+        # Dropout and MixStyle are identities in eval mode
+        if isinstance(module, (nn.Dropout, nn.Identity, MixStyle)):
+            continue
+        conv, pointwise, pool = module[0], [], None
+        for m in list(module)[1:]:
+            if isinstance(m, (nn.BatchNorm1d, nn.ReLU)):
+                pointwise.append(m)
+            elif isinstance(m, nn.MaxPool1d) and m.kernel_size == m.stride and m.padding == 0:
+                pool = m
+            elif isinstance(m, nn.AdaptiveMaxPool1d):
+                output_size = m.output_size
+            elif not isinstance(m, nn.Flatten):
+                raise Exception("Streaming does not support {} layers.".format(type(m).__name__))
+        layers.append(StreamingLayer(conv, nn.Sequential(*pointwise), pool))
+    return layers, output_size
+
+
+class StreamingModel(object):
+    '''
+    Incremental classification of overlapping windows of one or more synchronous streams with an InferenceModel.
+    window: Number of samples of a window, hop: Number of samples between the starts of consecutive windows.
+    norm_type: Normalization of the stream, calibrated on its first window (see aug.Normalize).
+    '''
+    def __init__(self, model, window, hop, norm_type='-1-1'):
+        if model.G.stem is not None:
+            raise Exception("Streaming does not support the shared-stem backbone.")
+        self.model = model.eval()
+        self.window, self.hop, self.norm_type = window, hop, norm_type
+        self.branches, self.output_sizes, self.spans = [], [], []
+        for branch in model.G.convs:
+            layers, output_size = get_streaming_layers(branch)
+            length = window
+            for layer in layers:
+                length = layer.length(length)
+            self.branches.append(layers)
+            self.output_sizes.append(output_size)
+            # Number of outputs of the last layer in a window
+            self.spans.append(length)
+        self.stride = int(np.prod([layer.pool_size for layer in self.branches[0]]))
+        if hop % self.stride != 0:
+            raise Exception("The hop must be a multiple of {} so that the windows align with the pooling.".format(self.stride))
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            self.num_classes = model(torch.zeros(1, model.G.convs[0].fs[0][0].in_channels, window, device=device)).shape[1]
+        self.reset()
+
+    def reset(self):
+        '''
+        Start new streams.
+        '''
+        self.calibration = None
+        self.scale = self.offset = None
+        self.num_windows = 0
+        self.buffers, self.starts = None, None
+
+    def _calibrate(self, input):
+        self.scale, self.offset = inference_utils.get_normalization(input[..., :self.window], self.norm_type)
+        for layers in self.branches:
+            for layer in layers:
+                layer.reset(input.shape[0], input.device)
+        self.buffers = [None] * len(self.branches)
+        self.starts = [0] * len(self.branches)
+
+    def push(self, input):
+        '''
+        Feed new samples (batch of streams, channels, samples) and return the logits of the windows completed
+        by them, with shape (windows, batch of streams, classes).
+        '''
+        if self.scale is None:
+            self.calibration = input if self.calibration is None else torch.cat((self.calibration, input), dim=-1)
+            if self.calibration.shape[-1] < self.window:
+                return input.new_zeros(0, input.shape[0], self.num_classes)
+            input, self.calibration = self.calibration, None
+            self._calibrate(input)
+        input = input * self.scale + self.offset
+
+        with torch.no_grad():
+            for b, layers in enumerate(self.branches):
+                x = input
+                for layer in layers:
+                    x = layer(x)
+                self.buffers[b] = x if self.buffers[b] is None else torch.cat((self.buffers[b], x), dim=-1)
+            return self._classify()
+
+    def _classify(self):
+        '''
+        Logits of every window of which the last layer outputs are complete in all branches.
+        '''
+        step = self.hop // self.stride
+        first = self.num_windows * step
+        num_windows = min([(self.starts[b] + self.buffers[b].shape[-1] - first - self.spans[b]) // step + 1
+                           for b in range(len(self.branches))])
+        batch_size = self.buffers[0].shape[0]
+        if num_windows <= 0:
+            return self.buffers[0].new_zeros(0, batch_size, self.num_classes)
+        features = []
+        for b in range(len(self.branches)):
+            start = first - self.starts[b]
+            out = self.buffers[b][..., start:start + (num_windows - 1) * step + self.spans[b]]
+            # (batch, channels, windows, span) -> (windows * batch, channels, span)
+            out = out.unfold(-1, self.spans[b], step).permute(2, 0, 1, 3).flatten(0, 1)
+            features.append(F.adaptive_max_pool1d(out, self.output_sizes[b]).flatten(1))
+            # Only keep the outputs of the next windows
+            next_start = first + num_windows * step
+            self.buffers[b] = self.buffers[b][..., next_start - self.starts[b]:]
+            self.starts[b] = next_start
+        self.num_windows += num_windows
+        logits = self.model.classify(self.model.G.fl(torch.cat(features, dim=1)))
+        return logits.view(num_windows, batch_size, -1)
+
+
+def windowed_predict(model, signal, window, hop, norm_type, batch_size=64):
+    '''
+    Logits of the windowed model on the overlapping windows of a signal (channels, samples), each
+    normalized on its own as in the datasets.
+    '''
+    windows = signal.unfold(-1, window, hop).transpose(0, 1)
+    logits = []
+    with torch.no_grad():
+        for batch in windows.split(batch_size):
+            scale, offset = inference_utils.get_normalization(batch, norm_type)
+            logits.append(model(batch * scale + offset))
+    return torch.cat(logits, dim=0)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    args = inference_utils.prepare_args(args)
+    trainer = inference_utils.build_trainer(args, init_data=False)
+    model = inference_utils.get_inference_model(trainer)
+    engine = StreamingModel(model, args.signal_size, args.hop, args.normlizetype)
+
+    if '_' in args.target:
+        tgt, condition = args.target.split('_')[0], int(args.target.split('_')[1])
+        data_root = os.path.join(args.data_dir, tgt, 'condition_%d' % condition)
+    else:
+        tgt = args.target
+        data_root = os.path.join(args.data_dir, tgt)
+    data_load = getattr(load_methods, tgt)
+
+    results = {'agreement': [], 'stream_acc': [], 'window_acc': [], 'stream_time': [], 'window_time': []}
+    for label, fault in enumerate(args.faults):
+        for item in sorted(os.listdir(os.path.join(data_root, fault))):
+            signal = np.asarray(data_load(os.path.join(data_root, fault, item)), dtype=np.float32).reshape(1, -1)
+            length = min(signal.shape[1], args.signal_size + (args.max_windows - 1) * args.hop)
+            signal = torch.from_numpy(signal[:, :length]).to(trainer.device)
+
+            # Online: the samples arrive hop by hop and every window is classified as soon as possible
+            start = time.perf_counter()
+            engine.reset()
+            stream_logits = torch.cat([engine.push(chunk.unsqueeze(0)) for chunk in signal.split(args.hop, dim=-1)])
+            stream_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            window_logits = windowed_predict(model, signal, args.signal_size, args.hop, args.normlizetype, batch_size=1)
+            window_time = time.perf_counter() - start
+
+            num_windows = len(stream_logits)
+            stream_pred, window_pred = stream_logits[:, 0].argmax(dim=1), window_logits[:num_windows].argmax(dim=1)
+            results['agreement'].append(float((stream_pred == window_pred).float().mean()))
+            results['stream_acc'].append(float((stream_pred == label).float().mean()))
+            results['window_acc'].append(float((window_pred == label).float().mean()))
+            results['stream_time'].append(stream_time / num_windows * 1000)
+            results['window_time'].append(window_time / len(window_logits) * 1000)
+            logging.info('{}/{}: {} windows, agreement {:.4f}, {:.2f} ms per hop streamed, {:.2f} ms per window windowed'.format(
+                         fault, item, num_windows, results['agreement'][-1], results['stream_time'][-1],
+                         results['window_time'][-1]))
+
+    logging.info('Agreement with the windowed model: {:.4f}'.format(np.mean(results['agreement'])))
+    logging.info('Accuracy: streamed {:.4f}, windowed {:.4f}'.format(np.mean(results['stream_acc']),
+                                                                     np.mean(results['window_acc'])))
+    logging.info('Time per hop: streamed {:.2f} ms, windowed {:.2f} ms'.format(np.mean(results['stream_time']),
+                                                                               np.mean(results['window_time'])))
+    logger.handlers.clear()
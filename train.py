@@ -3,9 +3,11 @@ import sys
 sys.path.extend(['./models', './data_loader'])
 import torch
 import logging
+import torch.nn as nn
 import importlib
 from datetime import datetime
 
+import conv_backend
 from opt import parse_args
 
 
@@ -77,6 +79,10 @@ if __name__ == '__main__':
         args.num_classes = len(args.faults)
     logging.info('Detect {} classes: {}'.format(args.num_classes, args.faults)) 
     trainer = importlib.import_module(f"models.{args.model_name}").Trainset(args)
+    if args.conv_backend != 'direct':
+        for m in vars(trainer).values():
+            if isinstance(m, nn.Module):
+                conv_backend.set_backend(m, args.conv_backend)
     if args.load_path:
         trainer.load_model()
         trainer.test()
@@ -66,6 +66,23 @@ class InitTrain(object):
         return optimizer
     
     
+    def _get_backbone_kwargs(self):
+        '''
+        Get the options of model_base.FeatureExtractor.
+        '''
+        args = self.args
+        return {'shared_stem': args.backbone == 'shared_stem', 'checkpoint': args.checkpoint,
+                'signal_size': args.signal_size}
+    
+    
+    def _get_mkmmd_kwargs(self):
+        '''
+        Get the options of utils.MultipleKernelMaximumMeanDiscrepancy.
+        '''
+        args = self.args
+        return {'tile_size': args.mmd_tile_size, 'estimator': args.mmd_estimator, 'num_features': args.mmd_features}
+    
+    
     def _get_tradeoff(self, tradeoff_list, epoch=None):
         '''
         Get trade-off parameters for loss.
@@ -0,0 +1,109 @@
+'''
+Monte-Carlo dropout uncertainty of a trained model (trained with --dropout > 0).
+--mc_samples stochastic passes with the dropout layers active are evaluated as one batched forward (see
+inference_utils.MCDropoutModel), in which the layers before the first dropout layer of every branch run once.
+The report compares the predictive mean with the deterministic model on the target validation set (accuracy,
+negative log-likelihood and expected calibration error), the entropy and mutual information of the correct and
+wrong predictions, the accuracy when the most uncertain windows are referred to an expert, and the latency of
+the batched passes against a loop of full forward passes.
+
+Example: Uncertainty of a DANN model trained with dropout from CWRU operation condition 0 to condition 1.
+python uncertainty.py --model_name DANN --load_path ./ckpt/DANN/single_source/**.pth --source CWRU_0 --target CWRU_1 --dropout 0.2 --mc_samples 30
+'''
+import sys
+sys.path.extend(['./models', './data_loader'])
+import json
+import torch
+import logging
+import numpy as np
+import torch.nn.functional as F
+
+import inference_utils
+from opt import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--mc_samples', type=int, default=20, help='Number of stochastic passes')
+    parser.add_argument('--reject_fraction', type=float, default=0.1,
+                        help='Fraction of the most uncertain windows referred to an expert')
+    parser.add_argument('--latency_batch_sizes', type=str, default='1,64',
+                        help='Batch sizes to measure the latency, separated by ","')
+    parser.add_argument('--report_path', type=str, default='./uncertainty_report.json', help='Path of the report')
+    args = parser.parse_args()
+    return args
+
+
+def calibration_error(probabilities, labels, bins=15):
+    '''
+    Expected calibration error: mean gap between the confidence and the accuracy over confidence bins.
+    '''
+    confidence, pred = probabilities.max(axis=1), probabilities.argmax(axis=1)
+    idx = np.minimum((confidence * bins).astype(int), bins - 1)
+    error = 0.
+    for b in range(bins):
+        mask = idx == b
+        if mask.any():
+            error += mask.mean() * abs((pred[mask] == labels[mask]).mean() - confidence[mask].mean())
+    return float(error)
+
+
+def summarize(probabilities, labels):
+    return {'accuracy': float((probabilities.argmax(axis=1) == labels).mean()),
+            'nll': float(-np.log(np.maximum(probabilities[np.arange(len(labels)), labels], 1e-12)).mean()),
+            'ece': calibration_error(probabilities, labels)}
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger = inference_utils.setlogger()
+    args = inference_utils.prepare_args(args)
+    trainer = inference_utils.build_trainer(args)
+    device, val_loader = trainer.device, trainer.dataloaders['val']
+    model = inference_utils.get_inference_model(trainer)
+    mc = inference_utils.MCDropoutModel(model, args.mc_samples)
+
+    labels, deterministic, mean, entropy, mi = [], [], [], [], []
+    with torch.no_grad():
+        for data, target, _ in val_loader:
+            data = data.to(device)
+            deterministic.append(F.softmax(model(data), dim=1).cpu())
+            outputs = mc.predict(data)
+            for results, out in zip([mean, entropy, mi], outputs):
+                results.append(out.cpu())
+            labels.append(target)
+    labels = torch.cat(labels).numpy()
+    deterministic, mean = torch.cat(deterministic).numpy(), torch.cat(mean).numpy()
+    entropy, mi = torch.cat(entropy).numpy(), torch.cat(mi).numpy()
+
+    report = {'mc_samples': args.mc_samples, 'deterministic': summarize(deterministic, labels),
+              'mc_dropout': summarize(mean, labels)}
+    for name, results in [('deterministic', report['deterministic']), ('mc_dropout', report['mc_dropout'])]:
+        logging.info('{}: acc {:.4f}, nll {:.4f}, ece {:.4f}'.format(name, results['accuracy'], results['nll'],
+                                                                     results['ece']))
+    correct = mean.argmax(axis=1) == labels
+    for name, u in [('entropy', entropy), ('mutual_information', mi)]:
+        # Accuracy on the windows kept after referring the most uncertain ones
+        keep = np.argsort(u)[:int(round(len(u) * (1 - args.reject_fraction)))]
+        report[name] = {'correct': float(u[correct].mean()) if correct.any() else None,
+                        'wrong': float(u[~correct].mean()) if (~correct).any() else None,
+                        'accuracy_after_rejection': float(correct[keep].mean())}
+        logging.info('{}: {} on correct, {} on wrong predictions, acc {:.4f} without the {:.0%} most uncertain'.format(
+                     name, report[name]['correct'], report[name]['wrong'], report[name]['accuracy_after_rejection'],
+                     args.reject_fraction))
+
+    example = next(iter(val_loader))[0]
+    for bs in [int(b) for b in args.latency_batch_sizes.split(',')]:
+        input = torch.randn(bs, *example.shape[1:], device=device)
+        report['latency_ms_bs%d' % bs] = {
+            'deterministic': inference_utils.measure_latency(model, input, repeats=5),
+            'loop': inference_utils.measure_latency(mc.sample_sequential, input, repeats=5),
+            'batched': inference_utils.measure_latency(mc.sample, input, repeats=5)}
+        logging.info('Batch size {}: {:.2f} ms batched, {:.2f} ms loop of {} passes, {:.2f} ms deterministic'.format(
+                     bs, report['latency_ms_bs%d' % bs]['batched'], report['latency_ms_bs%d' % bs]['loop'],
+                     args.mc_samples, report['latency_ms_bs%d' % bs]['deterministic']))
+
+    with open(args.report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    logging.info('Report saved to {}'.format(args.report_path))
+    logger.handlers.clear()
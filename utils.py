@@ -1,4 +1,5 @@
 import torch
+import torch.utils.checkpoint
 import numpy as np
 from torch import nn
 from torch.autograd import Function
@@ -80,6 +81,43 @@ def get_concat_dataset_next_batch(loaders, iters, src, device, return_idx=False)
         return inputs.to(device), labels.to(device)
 
 
+def get_multi_source_batch(loaders, iters, src, device):
+    '''
+    Next batch of every source domain in src, concatenated, with the index of the domain of every sample.
+    '''
+    inputs, labels = zip(*[get_next_batch(loaders, iters, key, device) for key in src])
+    sizes = torch.tensor([len(l) for l in labels], device=device)
+    domain_idx = torch.repeat_interleave(torch.arange(len(src), device=device), sizes)
+    return torch.cat(inputs, dim=0), torch.cat(labels, dim=0), domain_idx
+
+
+def segment_mean(values, segment_idx, num_segments):
+    '''
+    Mean of the values of every segment (0 for empty segments), along the first dimension.
+    '''
+    sums = values.new_zeros((num_segments,) + values.shape[1:]).index_add(0, segment_idx, values)
+    counts = torch.bincount(segment_idx, minlength=num_segments).clamp(min=1)
+    return sums / counts.view((-1,) + (1,) * (values.dim() - 1)).to(values.dtype)
+
+
+def per_domain_loss(preds, targets, domain_idx, num_domains):
+    '''
+    Cross-entropy loss and accuracy of every domain from one forward pass over the samples of all domains.
+    '''
+    loss = F.cross_entropy(preds, targets, reduction='none')
+    correct = torch.eq(preds.detach().argmax(dim=1), targets).to(loss.dtype)
+    return segment_mean(loss, domain_idx, num_domains), segment_mean(correct, domain_idx, num_domains)
+
+
+def pairwise_discrepancy(predictions):
+    '''
+    Sum of the mean absolute differences between every pair of heads, computed without a loop over pairs.
+    predictions: (num_heads, batch, num_classes)
+    '''
+    distance = torch.abs(predictions.unsqueeze(0) - predictions.unsqueeze(1)).mean(dim=(2, 3))
+    return distance.sum() / 2.
+
+
 class GradientReverseFunction(Function):
 
     @staticmethod
@@ -128,68 +166,131 @@ class WarmStartGradientReverseLayer(nn.Module):
         self.iter_num += 1
 
 
-def _update_index_matrix(batch_size, index_matrix = None, linear = True):
-    if index_matrix is None or index_matrix.size(0) != batch_size * 2:
-        index_matrix = torch.zeros(2 * batch_size, 2 * batch_size)
-        if linear:
-            '''
-            # Seems that this part is wrong.
-            for i in range(batch_size):
-                s1, s2 = i, (i + 1) % batch_size
-                t1, t2 = s1 + batch_size, s2 + batch_size
-                index_matrix[s1, s2] = 1. / float(batch_size)
-                index_matrix[t1, t2] = 1. / float(batch_size)
-                index_matrix[s1, t2] = -1. / float(batch_size)
-                index_matrix[s2, t1] = -1. / float(batch_size)
-            '''
-            # The following is the revised version.
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    index_matrix[i][j] = 1. / float(batch_size)
-                    index_matrix[i + batch_size][j + batch_size] = 1. / float(batch_size)
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    index_matrix[i][j + batch_size] = -1. / float(batch_size)
-                    index_matrix[i + batch_size][j] = -1. / float(batch_size)
-        else:
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    if i != j:
-                        index_matrix[i][j] = 1. / float(batch_size * (batch_size - 1))
-                        index_matrix[i + batch_size][j + batch_size] = 1. / float(batch_size * (batch_size - 1))
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    index_matrix[i][j + batch_size] = -1. / float(batch_size * batch_size)
-                    index_matrix[i + batch_size][j] = -1. / float(batch_size * batch_size)
-
-    return index_matrix
-
-
 class MultipleKernelMaximumMeanDiscrepancy(nn.Module):
 
-    def __init__(self, kernels, linear = True):
+    def __init__(self, kernels, linear = True, tile_size = 0, estimator = 'quadratic', num_features = 1024):
         super(MultipleKernelMaximumMeanDiscrepancy, self).__init__()
         self.kernels = kernels
-        self.index_matrix = None
         self.linear = linear
+        # tile_size: If positive, the kernel matrices are computed in blocks of tile_size rows, which are
+        # recomputed in the backward pass, so the memory grows linearly with the batch size
+        self.tile_size = tile_size
+        # estimator: 'quadratic' uses the full kernel matrices, 'linear_time' the unbiased estimate over
+        # disjoint pairs of samples (Gretton et al., 2012), and 'rff' the distance between the mean random
+        # Fourier features (num_features per kernel) of the domains, which only supports Gaussian kernels
+        assert estimator in ['quadratic', 'linear_time', 'rff'], f"estimator should be 'quadratic', 'linear_time' or 'rff', but got {estimator}"
+        if estimator != 'quadratic' and not self._shared_distances():
+            raise Exception("The {} MMD estimator only supports Gaussian kernels.".format(estimator))
+        self.estimator = estimator
+        self.num_features = num_features
+        self.rff_weight, self.rff_bias = None, None
+
+    def _shared_distances(self):
+        return all([isinstance(kernel, GaussianKernel) for kernel in self.kernels])
+
+    def _update_bandwidths(self, *features):
+        # Mean squared distance of all pairs of samples of features, in linear time from the centered features
+        with torch.no_grad():
+            n = sum([f.size(0) for f in features])
+            mean = sum([f.sum(dim=0) for f in features]) / n
+            mean_distance_square = 2 * sum([(f - mean).pow(2).sum() for f in features]) / n
+        for kernel in self.kernels:
+            kernel.update_sigma(mean_distance_square)
+
+    def _kernel_matrix(self, features):
+        if not self._shared_distances():
+            return sum([kernel(features) for kernel in self.kernels])
+        # The squared distances are shared by all bandwidths
+        self._update_bandwidths(features)
+        features = features - features.mean(dim=0)
+        d = pairwise_distance_square(features)
+        return sum([kernel.from_distance(d) for kernel in self.kernels])
+
+    def _linear_time(self, z_s, z_t):
+        self._update_bandwidths(z_s, z_t)
+        n = min(z_s.size(0), z_t.size(0)) // 2
+        # x1 - x2, y1 - y2, x1 - y2 and x2 - y1 of every quadruple (x1, x2, y1, y2) with one matmul
+        samples = torch.cat([z_s[:2*n].view(n, 2, -1), z_t[:2*n].view(n, 2, -1)], dim=1)
+        signs = z_s.new_tensor([[1, -1, 0, 0], [0, 0, 1, -1], [1, 0, 0, -1], [0, 1, -1, 0]])
+        d = torch.matmul(signs, samples).pow(2).sum(dim=-1)
+        k = sum([kernel.from_distance(d) for kernel in self.kernels])
+        return (k[:, 0] + k[:, 1] - k[:, 2] - k[:, 3]).mean()
+
+    def _random_features(self, z_s, z_t):
+        self._update_bandwidths(z_s, z_t)
+        if self.rff_weight is None or self.rff_weight.shape[0] != z_s.size(1) or \
+           self.rff_weight.device != z_s.device:
+            self.rff_weight = torch.randn(z_s.size(1), self.num_features, device=z_s.device)
+            self.rff_bias = 2 * np.pi * torch.rand(self.num_features, device=z_s.device)
+        # k(x, y) = E[2 cos(w.x / sigma + b) cos(w.y / sigma + b)] with w ~ N(0, I), so one projection serves all bandwidths
+        def mean_features(z):
+            projection = torch.mm(z, self.rff_weight.to(z.dtype))
+            return torch.cat([torch.cos(projection / kernel.sigma_square.sqrt() + self.rff_bias).mean(dim=0)
+                              for kernel in self.kernels]) * np.sqrt(2. / self.num_features)
+        return (mean_features(z_s) - mean_features(z_t)).pow(2).sum()
+
+    def _block_sums(self, kernel_matrix, batch_size, start = 0):
+        '''
+        Sums of rows start, start+1, ... of the kernel matrix over the same-domain blocks, over the cross-domain
+        blocks and over the diagonal.
+        '''
+        rows = torch.arange(start, start + kernel_matrix.size(0), device=kernel_matrix.device) < batch_size
+        cols = torch.arange(kernel_matrix.size(1), device=kernel_matrix.device) < batch_size
+        same = kernel_matrix.masked_fill(rows.unsqueeze(1) != cols, 0.).sum()
+        return torch.stack([same, kernel_matrix.sum() - same, kernel_matrix.diagonal(offset=start).sum()])
+
+    def _tiled_block_sums(self, features, batch_size):
+        self._update_bandwidths(features)
+        features = features - features.mean(dim=0)
+        def block(x, y, start):
+            d = pairwise_distance_square(x, y)
+            return self._block_sums(sum([kernel.from_distance(d) for kernel in self.kernels]), batch_size, start)
+        total = 0.
+        for start in range(0, features.size(0), self.tile_size):
+            x = features[start:start+self.tile_size]
+            if torch.is_grad_enabled() and features.requires_grad:
+                total = total + torch.utils.checkpoint.checkpoint(block, x, features, start, use_reentrant=False)
+            else:
+                total = total + block(x, features, start)
+        return total
 
     def forward(self, z_s, z_t):
+        if self.estimator == 'linear_time':
+            return self._linear_time(z_s, z_t)
+        if self.estimator == 'rff':
+            return self._random_features(z_s, z_t)
         features = torch.cat([z_s, z_t], dim=0)
         batch_size = int(z_s.size(0))
-        self.index_matrix = _update_index_matrix(batch_size, self.index_matrix, self.linear).to(z_s.device)
 
-        # Add up the matrix of each kernel
-        kernel_matrix = sum([kernel(features) for kernel in self.kernels])
+        if self.tile_size > 0 and features.size(0) > self.tile_size and self._shared_distances():
+            same, cross, diagonal = self._tiled_block_sums(features, batch_size)
+        else:
+            # Add up the matrix of each kernel
+            same, cross, diagonal = self._block_sums(self._kernel_matrix(features), batch_size)
+        # The weights of the blocks are constant, so the weighted sum is taken from the block sums: 1 / n for
+        # the same-domain and -1 / n for the cross-domain blocks in the linear version, and 1 / (n (n-1))
+        # without the diagonal and -1 / n^2 in the non-linear version.
         # Add 2 / (n-1) to make up for the value on the diagonal
         # to ensure loss is positive in the non-linear version
         if self.linear:
-            loss = (kernel_matrix * self.index_matrix).sum() / float(batch_size - 1)
+            loss = (same - cross) / float(batch_size) / float(batch_size - 1)
         else:
-            loss = (kernel_matrix * self.index_matrix).sum() + 2. / float(batch_size - 1)
+            loss = (same - diagonal) / float(batch_size * (batch_size - 1)) - cross / float(batch_size * batch_size) \
+                   + 2. / float(batch_size - 1)
 
         return loss
 
 
+def pairwise_distance_square(X, Y = None):
+    '''
+    Squared Euclidean distances between the rows of X and the rows of Y (X if None), from the Gram matrix
+    instead of the (n, m, features) differences.
+    '''
+    Y = X if Y is None else Y
+    distance = X.pow(2).sum(dim=1, keepdim=True) + Y.pow(2).sum(dim=1) - 2 * torch.mm(X, Y.t())
+    return distance.clamp(min=0)
+
+
 class GaussianKernel(nn.Module):
 
     def __init__(self, sigma = None, track_running_stats = True, alpha = 1.):
@@ -199,14 +300,20 @@ class GaussianKernel(nn.Module):
         self.track_running_stats = track_running_stats
         self.alpha = alpha
 
-    def forward(self, X):
-        l2_distance_square = ((X.unsqueeze(0) - X.unsqueeze(1)) ** 2).sum(2)
-
+    def update_sigma(self, mean_distance_square):
         if self.track_running_stats:
-            self.sigma_square = self.alpha * torch.mean(l2_distance_square.detach())
+            self.sigma_square = self.alpha * mean_distance_square.detach()
 
+    def from_distance(self, l2_distance_square):
         return torch.exp(-l2_distance_square / (2 * self.sigma_square))
 
+    def forward(self, X):
+        # The distances do not change when X is centered, which reduces the rounding errors of the Gram matrix
+        l2_distance_square = pairwise_distance_square(X - X.mean(dim=0))
+        self.update_sigma(torch.mean(l2_distance_square))
+
+        return self.from_distance(l2_distance_square)
+
 
 class DomainAdversarialLoss(nn.Module):
 
@@ -236,3 +343,66 @@ class DomainAdversarialLoss(nn.Module):
                                     self.bce(d_t, d_label_t, w_t.view_as(d_t)))
         return loss, d_accuracy
 
+
+
+class MultiLinearMap(nn.Module):
+    '''
+    Outer product of the predictions g and the features f, flattened to (batch, num_classes * features_dim).
+    '''
+    def __init__(self, features_dim = -1, num_classes = -1):
+        super(MultiLinearMap, self).__init__()
+        self.output_dim = features_dim * num_classes
+
+    def forward(self, f, g):
+        batch_size = f.size(0)
+        output = torch.bmm(g.unsqueeze(2), f.unsqueeze(1))
+        return output.view(batch_size, -1)
+
+
+class RandomizedMultiLinearMap(nn.Module):
+    '''
+    Product of fixed random projections of the features and of the predictions.
+    '''
+    def __init__(self, features_dim, num_classes, output_dim = 1024):
+        super(RandomizedMultiLinearMap, self).__init__()
+        # Buffers, so that the projections follow the module to its device and are not trained
+        self.register_buffer('Rf', torch.randn(features_dim, output_dim))
+        self.register_buffer('Rg', torch.randn(num_classes, output_dim))
+        self.output_dim = output_dim
+
+    def forward(self, f, g):
+        f = torch.mm(f, self.Rf)
+        g = torch.mm(g, self.Rg)
+        output = torch.mul(f, g) / np.sqrt(float(self.output_dim))
+        return output
+
+
+class FactorizedMultiLinearMap(nn.Module):
+    '''
+    Approximation of the outer product input by a learned Linear layer on it, whose weight of every output unit
+    is the rank-1 product of a feature and a class weight vector. (f U) * (g V) gives the output without the
+    outer product, in memory and FLOPs independent of the number of classes, but it is a different (smaller)
+    discriminator than the one on the full outer product.
+    '''
+    def __init__(self, features_dim, num_classes, output_dim = 1024):
+        super(FactorizedMultiLinearMap, self).__init__()
+        self.U = nn.Linear(features_dim, output_dim, bias=False)
+        self.V = nn.Linear(num_classes, output_dim, bias=False)
+        self.output_dim = output_dim
+
+    def forward(self, f, g):
+        return self.U(f) * self.V(g)
+
+
+def get_multilinear_map(name, features_dim, num_classes, output_dim = 1024):
+    '''
+    Conditional discriminator input of CDAN and ACDANN, see the --multilinear option.
+    '''
+    assert name in ['full', 'randomized', 'factorized'], \
+        f"multilinear map should be 'full', 'randomized' or 'factorized', but got {name}"
+    if name == 'full':
+        return MultiLinearMap(features_dim, num_classes)
+    elif name == 'randomized':
+        return RandomizedMultiLinearMap(features_dim, num_classes, output_dim)
+    else:
+        return FactorizedMultiLinearMap(features_dim, num_classes, output_dim)